@@ -1,52 +1,40 @@
-from database import Hdf5Client
-from utils import resample_timeframe, START_PARAMS
-import strategies.obv, strategies.ichimoku, strategies.support_resistance
+from database import open_bars_source
+from utils import START_PARAMS
+from registry import get_strategy
+import typing
 import pandas as pd
 
 pd.set_option("display.max_columns", None)
 pd.set_option("display.max_rows", None)
 pd.set_option("display.width", 1_000)
 
-def run(exchange: str, symbol: str, strategy: str, tf: str, from_time: int, to_time: int):
-    
-    params_des = START_PARAMS[strategy.lower()]
-    
-    params = {}
-    
-    for key, value in params_des.items():
-        while True:
-            try:
-                params[key] = value["type"](input(value["name"] + ":"))
-                break
-            except ValueError:
-                continue
-    
-    if strategy == "obv":
-        h5_db = Hdf5Client(exchange)
-        data = h5_db.get_data(symbol, from_time, to_time)
-        data = resample_timeframe(data, tf)
-        
-        pnl, max_dd= strategies.obv.backtest(data, ma_period = params["ma_period"])
-        
-        return pnl, max_dd
-        
-    elif strategy == "ichimoku":
-        h5_db = Hdf5Client(exchange)
-        data = h5_db.get_data(symbol, from_time, to_time)
-        data = resample_timeframe(data, tf)
-        data.columns = ["Open", "High", "Low", "Close", "Volume"]
-        
-        pnl, max_dd = strategies.ichimoku.backtest(data, tenkan_period = params["kijun"], kijun_period = params["tenkan"])
-        
-        return pnl, max_dd
-        
-    elif strategy == "sup_res":
-        h5_db = Hdf5Client(exchange)
-        data = h5_db.get_data(symbol, from_time, to_time)
-        data = resample_timeframe(data, tf)
-        # data.columns = ["Open", "High", "Low", "Close", "Volume"]
-        
-        pnl, max_dd = strategies.support_resistance.backtest(data, min_points = params["min_points"], min_diff_points = params["min_diff_points"],
-                                                     rounding_nb = params["rounding_nb"], take_profit = params["take_profit"], stop_loss = params["stop_loss"]) 
-        
-        return pnl, max_dd
\ No newline at end of file
+def run(exchange: str, symbol: str, strategy: str, tf: str, from_time: int, to_time: int,
+        params: typing.Optional[typing.Dict] = None, options: typing.Optional[typing.Dict] = None):
+
+    # The parameters are asked when they are not given (interactive mode)
+    if params is None:
+        params_des = START_PARAMS[strategy.lower()]
+
+        params = {}
+
+        for key, value in params_des.items():
+            while True:
+                try:
+                    params[key] = value["type"](input(value["name"] + ":"))
+                    break
+                except ValueError:
+                    continue
+
+    db = open_bars_source(exchange, symbol, tf)
+    data = db.get_resampled_data(symbol, tf, from_time, to_time)
+
+    pnl, max_dd = backtest(strategy, data, params, options)
+
+    return pnl, max_dd
+
+
+def backtest(strategy: str, data: pd.DataFrame, params: typing.Dict,
+             options: typing.Optional[typing.Dict] = None) -> typing.Tuple[float, float]:
+    # Backtest one set of parameters on bars already loaded, the data is only read
+    # (options: fee / slippage of the strategies that have them)
+    return get_strategy(strategy, **(options or dict())).backtest(data, params)
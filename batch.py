@@ -0,0 +1,355 @@
+# Non-interactive backtest / optimize sweeps: every combination of
+# exchanges x symbols x strategies x timeframes x windows x parameters is run in parallel
+# and the results are written as one table (.parquet, .json or .jsonl)
+#
+# Example: python batch.py --spec sweep.json --output results.parquet --jobs 8
+# with sweep.json:
+# {
+#     "mode": "backtest",
+#     "exchange": "binance",
+#     "symbols": ["BTCUSDT", "ETHUSDT"],
+#     "strategies": ["obv"],
+#     "timeframes": ["1h", "4h"],
+#     "windows": [["2021-01-01", "2021-07-01"], ["2021-07-01", null]],
+#     "params": {"obv": {"ma_period": {"min": 5, "max": 200, "step": 5}}}
+# }
+# or with flags: python batch.py --mode backtest --exchange binance --symbols BTCUSDT --strategies obv
+#                --timeframes 1h --param ma_period=5:200:5 --output results.jsonl
+# Parameters missing from "params" take "points" values spread over their START_PARAMS range (10 by default),
+# and "random": N replaces the grids by N random parameter sets ("seed" to repeat them).
+# In optimize mode each job is a whole NSGA-II run ("population_size", "generations", "seed")
+# and the last population is written. "patience" and "min_improvement" stop a run once its front
+# stops improving. With "basket": true the symbols are optimized together (mean pnl, worst drawdown)
+# instead of one run per symbol. "fidelity": [[0.1, 0.3], [0.3, 0.5]] screens the offspring on the last 10 %
+# of the bars, then the best 30 % of them on the last 30 %, and only the best half of those on the whole window
+# (--fidelity 0.1:0.3,0.3:0.5). "fee" and "slippage" (fractions of the price) apply to the strategies that
+# simulate their trades (sup_res).
+# The exit status is 1 when a task failed, the results of the other tasks are still written.
+
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from database import MmapClient, open_bars_source
+from utils import SharedFrame, attach_shared_frame, START_PARAMS, TF_EQUIV
+import optimizer
+import registry
+import sweep
+
+logger = logging.getLogger()
+
+MODES = ["backtest", "optimize"]
+STRATEGIES = list(registry.STRATEGIES)
+OUTPUT_FORMATS = [".parquet", ".json", ".jsonl"]
+
+# Bars of each window already attached by a worker process
+_worker_data = dict()
+
+
+def parse_time(value: typing.Union[None, int, str], default: int) -> int:
+    # Milliseconds, or a yyyy-mm-dd date like the interactive mode
+    if value is None or value == "":
+        return default
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    return int(datetime.datetime.strptime(value, "%Y-%m-%d").timestamp() * 1_000)
+
+
+def param_values(strategy: str, name: str, values: typing.Union[typing.List, typing.Dict, str]) -> typing.List:
+    # A list of values, a {"min", "max", "step"} range or the "min:max:step" / "v1,v2" flag syntax
+    if name not in START_PARAMS[strategy]:
+        raise ValueError(f"{strategy} has no parameter {name}, choose among {list(START_PARAMS[strategy])}")
+    param_type = START_PARAMS[strategy][name]["type"]
+
+    if isinstance(values, str):
+        if ":" in values:
+            values = dict(zip(["min", "max", "step"], values.split(":")))
+        else:
+            values = values.split(",")
+
+    if isinstance(values, dict):
+        # Both bounds included
+        step = float(values.get("step", 1))
+        values = np.arange(float(values["min"]), float(values["max"]) + step / 2, step)
+
+    if param_type == float:
+        return [round(float(v), START_PARAMS[strategy][name]["decimals"]) for v in values]
+    return [param_type(float(v)) for v in values]
+
+
+def param_grid(strategy: str, grid: typing.Dict, points: int = 10) -> typing.List[typing.Dict]:
+    # Every combination of the parameter values of the strategy
+    names = list(START_PARAMS[strategy].keys())
+
+    unknown = [name for name in grid if name not in names]
+    if len(unknown) > 0:
+        raise ValueError(f"{strategy} has no parameters {unknown}, choose among {names}")
+
+    values = [param_values(strategy, name, grid[name]) if name in grid else sweep.grid_values(strategy, name, points)
+              for name in names]
+
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def expand_jobs(spec: typing.Dict) -> typing.List[typing.Dict]:
+    """
+    One job per exchange, symbol, strategy, timeframe and window of the sweep spec
+    """
+    mode = spec.get("mode", "backtest")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode}, choose among {MODES}")
+
+    for key in ["symbols", "strategies", "timeframes"]:
+        if len(spec.get(key, [])) == 0:
+            raise ValueError(f"The sweep spec has no {key}")
+
+    exchanges = spec.get("exchanges", [spec.get("exchange")])
+    windows = spec.get("windows", [[None, None]])
+    now = int(time.time() * 1_000)
+
+    for key, values, choices in [("exchanges", exchanges, ["ftx", "binance"]), ("strategies", spec["strategies"], STRATEGIES),
+                                 ("timeframes", spec["timeframes"], list(TF_EQUIV))]:
+        unknown = [v for v in values if v not in choices]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown {key} {unknown}, choose among {choices}")
+
+    # Expanded once per strategy, so errors show up before anything runs
+    grids = dict()
+    if mode == "backtest" and "random" in spec:
+        rng = np.random.default_rng(spec.get("seed"))
+        grids = {strategy: sweep.random_params(strategy, int(spec["random"]), rng) for strategy in spec["strategies"]}
+    elif mode == "backtest":
+        grids = {strategy: param_grid(strategy, spec.get("params", dict()).get(strategy, dict()), int(spec.get("points", 10)))
+                 for strategy in spec["strategies"]}
+
+    # A basket is a single "symbol" made of every symbol
+    symbols = [spec["symbols"]] if mode == "optimize" and spec.get("basket", False) else spec["symbols"]
+
+    jobs = []
+    for exchange, symbol, strategy, tf, (from_time, to_time) in itertools.product(exchanges, symbols, spec["strategies"],
+                                                                                 spec["timeframes"], windows):
+        job = {"mode": mode, "exchange": exchange, "symbol": symbol, "strategy": strategy, "tf": tf,
+               "from_time": parse_time(from_time, 0), "to_time": parse_time(to_time, now),
+               "options": registry.strategy_options(strategy, spec)}
+        if mode == "backtest":
+            job["params"] = grids[strategy]
+        else:
+            job.update(population_size = int(spec.get("population_size", 50)), generations = int(spec.get("generations", 10)),
+                       seed = spec.get("seed"), patience = spec.get("patience"), min_improvement = float(spec.get("min_improvement", 1e-3)),
+                       fidelity = spec.get("fidelity"))
+        jobs.append(job)
+
+    return jobs
+
+
+def run_sweep(spec: typing.Dict, jobs: int = 1) -> typing.Tuple[pd.DataFrame, int]:
+    """
+    Run every job of the spec on a pool of processes, one row per backtest
+    (backtest mode) or per individual of the last population (optimize mode),
+    and the number of failed tasks (their rows are missing)
+    """
+    sweep_jobs = expand_jobs(spec)
+
+    # The bars of each window are read once in this process (the HDF5 file can not be opened
+    # by several processes) and shared with the workers
+    sources = dict()
+    shared = []
+    tasks = []
+
+    try:
+        for job in sweep_jobs:
+            data = dict()
+            for symbol in (job["symbol"] if isinstance(job["symbol"], list) else [job["symbol"]]):
+                window = (job["exchange"], symbol, job["tf"], job["from_time"], job["to_time"])
+
+                if window not in sources:
+                    sources[window] = share_window(*window, shared)
+                    if sources[window] is None:
+                        logger.warning("%s %s %s: No data from %s to %s, jobs skipped", *window)
+                if sources[window] is not None:
+                    data[symbol] = sources[window]
+
+            if len(data) == 0:
+                continue
+
+            if job["mode"] == "backtest":
+                # Big grids are split so a single job still uses every process
+                # (sorted first so the parameter sets sharing indicators stay in the same task)
+                job["params"] = sorted(job["params"], key = lambda p: tuple(p.values()))
+                size = max(1, -(-len(job["params"]) // jobs))
+                for i in range(0, len(job["params"]), size):
+                    tasks.append(dict(job, params = job["params"][i:i + size], data = data))
+            else:
+                tasks.append(dict(job, data = data))
+
+        logger.info("Running %s jobs (%s tasks) on %s processes", len(sweep_jobs), len(tasks), jobs)
+
+        results = [None] * len(tasks)
+        failed = 0
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            futures = {executor.submit(_run_task, task): i for i, task in enumerate(tasks)}
+            for future in as_completed(futures):
+                task = tasks[futures[future]]
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    failed += 1
+                    logger.error("%s %s %s %s: Task failed: %s", task["exchange"], task["symbol"], task["strategy"], task["tf"], e)
+
+        if failed > 0:
+            logger.warning("%s tasks out of %s failed", failed, len(tasks))
+    finally:
+        for frame in shared:
+            frame.close()
+
+    # Order of the jobs of the spec whatever the order the tasks finished in,
+    # the parameter sets of a backtest job are sorted by value (see above)
+    rows = [row for result in results if result is not None for row in result]
+
+    return pd.DataFrame(rows), failed
+
+
+def write_results(results: pd.DataFrame, path: str):
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == ".parquet":
+        # Needs pyarrow or fastparquet
+        results.to_parquet(path, index = False)
+    elif extension == ".json":
+        results.to_json(path, orient = "records")
+    elif extension == ".jsonl":
+        results.to_json(path, orient = "records", lines = True)
+    else:
+        raise ValueError(f"Unknown output format {extension}, choose among {OUTPUT_FORMATS}")
+
+    logger.info("Wrote %s results to %s", len(results), path)
+
+
+def share_window(exchange: str, symbol: str, tf: str, from_time: int, to_time: int,
+                 shared: typing.List[SharedFrame]) -> typing.Union[None, typing.Dict]:
+    # Spec given to window_data in the worker processes (None if there are no bars),
+    # the shared memory blocks are added to shared and must be closed by the caller
+    db = open_bars_source(exchange, symbol, tf)
+
+    if isinstance(db, MmapClient):
+        # The workers map the exported files themselves
+        return {"mmap": exchange, "symbol": symbol, "tf": tf, "from_time": from_time, "to_time": to_time}
+
+    if symbol not in db.hf:
+        return None
+
+    data = db.get_resampled_data(symbol, tf, from_time, to_time)
+    if data is None or len(data) == 0:
+        return None
+
+    frame = SharedFrame(data)
+    shared.append(frame)
+
+    return frame.spec
+
+
+def window_data(spec: typing.Dict) -> pd.DataFrame:
+    # Attached once per worker process, the tasks of the same window reuse it
+    key = json.dumps(spec, sort_keys = True, default = str)
+
+    if key not in _worker_data:
+        if "mmap" in spec:
+            _worker_data[key] = (MmapClient(spec["mmap"]).get_resampled_data(spec["symbol"], spec["tf"], spec["from_time"],
+                                                                             spec["to_time"]), [])
+        else:
+            _worker_data[key] = attach_shared_frame(spec)
+
+    return _worker_data[key][0]
+
+
+def _run_task(task: typing.Dict) -> typing.List[typing.Dict]:
+    data = {symbol: window_data(spec) for symbol, spec in task["data"].items()}
+    job = {key: task[key] for key in ["exchange", "symbol", "strategy", "tf", "from_time", "to_time"]}
+    job.update(task["options"])
+
+    if task["mode"] == "backtest":
+        # Indicators shared by several parameter sets are computed once
+        results = sweep.backtest_many(task["strategy"], data[task["symbol"]], task["params"], options = task["options"])
+        return [dict(job, **params, pnl = pnl, max_dd = max_dd) for params, (pnl, max_dd) in zip(task["params"], results)]
+
+    # The bars are given to the optimizer, only this process evaluates the population
+    nsga2 = optimizer.Nsga2(task["exchange"], list(data) if isinstance(task["symbol"], list) else task["symbol"], task["strategy"],
+                            task["tf"], task["from_time"], task["to_time"], task["population_size"], seed = task["seed"], data = data,
+                            fidelity = task["fidelity"], options = task["options"])
+    population = nsga2.optimize(task["generations"], patience = task["patience"], min_improvement = task["min_improvement"])
+    nsga2.close()
+    job["symbol"] = nsga2.symbol
+
+    return [dict(job, **bt.parameters, pnl = bt.pnl, max_dd = bt.max_dd, rank = bt.rank,
+                 crowding_distance = bt.crowding_distance) for bt in population]
+
+
+def _parse_args() -> typing.Tuple[typing.Dict, argparse.Namespace]:
+    parser = argparse.ArgumentParser(description = "Run backtest / optimize sweeps without prompts")
+    parser.add_argument("--spec", help = "JSON sweep spec, the other flags override its values")
+    parser.add_argument("--mode", choices = MODES)
+    parser.add_argument("--exchange", dest = "exchanges", nargs = "+", help = "Exchanges (ftx / binance)")
+    parser.add_argument("--symbols", nargs = "+")
+    parser.add_argument("--strategies", nargs = "+", choices = STRATEGIES)
+    parser.add_argument("--timeframes", nargs = "+", choices = list(TF_EQUIV))
+    parser.add_argument("--from", dest = "from_time", help = "yyyy-mm-dd or milliseconds (one window with --to)")
+    parser.add_argument("--to", dest = "to_time", help = "yyyy-mm-dd or milliseconds")
+    parser.add_argument("--param", action = "append", default = [],
+                        help = "name=v1,v2,... or name=min:max:step, for every strategy with this parameter")
+    parser.add_argument("--points", type = int, help = "Grid values of the parameters without --param")
+    parser.add_argument("--random", type = int, help = "Random parameter sets instead of grids")
+    parser.add_argument("--basket", action = "store_true", default = None, help = "Optimize the symbols together")
+    parser.add_argument("--population-size", type = int)
+    parser.add_argument("--generations", type = int)
+    parser.add_argument("--patience", type = int, help = "Stop an optimization after this many generations without improvement")
+    parser.add_argument("--min-improvement", type = float, help = "Relative hypervolume improvement counted as progress")
+    parser.add_argument("--fidelity", type = optimizer.parse_fidelity,
+                        help = "Screen the offspring on the last part of the window first: window:keep,window:keep,...")
+    parser.add_argument("--fee", type = float, help = "Fee paid on both sides of a trade (sup_res), fraction of the price")
+    parser.add_argument("--slippage", type = float, help = "Slippage of each fill (sup_res), fraction of the price")
+    parser.add_argument("--seed", type = int)
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(), help = "Number of processes")
+    parser.add_argument("--output", required = True, help = "Results file (" + " / ".join(OUTPUT_FORMATS) + ")")
+    args = parser.parse_args()
+
+    spec = dict()
+    if args.spec is not None:
+        with open(args.spec) as f:
+            spec = json.load(f)
+
+    for key in ["mode", "exchanges", "symbols", "strategies", "timeframes", "points", "random", "basket", "population_size",
+                "generations", "patience", "min_improvement", "fidelity", "fee", "slippage", "seed"]:
+        if getattr(args, key) is not None:
+            spec[key] = getattr(args, key)
+
+    if args.from_time is not None or args.to_time is not None:
+        spec["windows"] = [[args.from_time, args.to_time]]
+
+    for param in args.param:
+        name, values = param.split("=", 1)
+        for strategy in spec.get("strategies", []):
+            if name in START_PARAMS[strategy]:
+                spec.setdefault("params", dict()).setdefault(strategy, dict())[name] = values
+
+    return spec, args
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s :: %(message)s")
+
+    spec, args = _parse_args()
+
+    results, failed = run_sweep(spec, max(1, args.jobs))
+    write_results(results, args.output)
+
+    # The results of the other tasks are written, but a partial sweep must not look successful to a scheduler
+    if failed > 0:
+        sys.exit(1)
@@ -2,8 +2,12 @@ import logging
 import typing
 
 import time
+import asyncio
+import queue
+import threading
+import numpy as np
 
-from database import Hdf5Client
+from database import Hdf5Client, MmapClient, MMAP_TFS
 from exchanges.binance import BinanceClient
 from exchanges.ftx import FtxClient
 from utils import *
@@ -12,107 +16,335 @@ from utils import *
 # Get logger
 logger = logging.getLogger()
 
-def collect_all(client: typing.Union[BinanceClient, FtxClient], exchange:str, symbol: str):
+# Requests per second and burst size allowed by each exchange, shared by all its symbols
+RATE_LIMITS = {"binance": (10, 20), "ftx": (25, 25)}
+# Older candles written at once: each write before the stored candles moves all of them,
+# so the backward collection is merged in large blocks (~48 MB) instead of every batch_size candles
+OLDER_BLOCK_ROWS = 1_000_000
+
+
+class TokenBucket:
+
+    """
+    Rate limiter shared by the collection tasks of one exchange: a request
+    waits only if the exchange limit would be exceeded
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CandleWriter:
+
+    """
+    Single writer thread of an exchange database. Collection tasks push raw
+    kline batches on a bounded queue and the candles are written in large
+    batches, so requests and disk writes overlap
+    """
+
+    def __init__(self, h5_db: Hdf5Client, batch_size: int = 10_000, queue_size: int = 100):
+        self.h5_db = h5_db
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._buffers: typing.Dict[str, typing.List[np.ndarray]] = dict()
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def put(self, symbol: str, data: typing.Union[np.ndarray, typing.List[typing.Tuple]]):
+        # Blocks when the queue is full so fetching can not get too far ahead of the disk
+        self._raise_error()
+        if self._closed:
+            raise RuntimeError("Candle writer closed")
+        self._queue.put((symbol, data, None))
+
+    def flush(self, symbol: str):
+        # Wait until every candle of the symbol put before is written
+        done = threading.Event()
+        self._queue.put((symbol, None, done))
+        done.wait()
+        self._raise_error()
+
+    def close(self):
+        # The buffered candles are written, the candles put after close are not
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Candle writer failed") from self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                # Every symbol is written even when another one fails, close raises the error
+                for symbol in list(self._buffers):
+                    try:
+                        self._write(symbol)
+                    except Exception as e:
+                        logger.error("%s: Error while writing candles: %s", symbol, e)
+                        self._error = e
+                break
+
+            symbol, data, done = item
+            try:
+                if data is not None and len(data) > 0:
+                    self._buffers.setdefault(symbol, []).append(np.asarray(data, dtype = "float64").reshape(-1, 6))
+                    if sum(len(d) for d in self._buffers[symbol]) >= self.batch_size:
+                        self._write(symbol)
+                if done is not None:
+                    self._write(symbol)
+            except Exception as e:
+                # Keep consuming so the producers are not blocked, the error is raised on their side
+                logger.error("%s: Error while writing candles: %s", symbol, e)
+                self._error = e
+            finally:
+                if done is not None:
+                    done.set()
+
+    def _write(self, symbol: str):
+        buffers = self._buffers.pop(symbol, [])
+        if len(buffers) > 0:
+            self.h5_db.write_data(symbol, np.concatenate(buffers))
+
+
+def collect_all(client: typing.Union[BinanceClient, FtxClient], exchange:str, symbol: str, swmr: bool = False):
+    collect_symbols(client, exchange, [symbol], swmr = swmr)
+
+
+def collect_symbols(client: typing.Union[BinanceClient, FtxClient], exchange: str, symbols: typing.List[str],
+                    batch_size: int = 10_000, swmr: bool = False):
+    asyncio.run(collect_many([(client, exchange, symbol) for symbol in symbols], batch_size, swmr))
+
+
+def backfill_symbols(client: typing.Union[BinanceClient, FtxClient], exchange: str, symbols: typing.List[str],
+                     batch_size: int = 10_000):
+    asyncio.run(backfill_many([(client, exchange, symbol) for symbol in symbols], batch_size))
+
+
+async def collect_many(jobs: typing.List[typing.Tuple[typing.Union[BinanceClient, FtxClient], str, str]],
+                       batch_size: int = 10_000, swmr: bool = False):
+    # Collect several symbols (of one or several exchanges) concurrently
+    # With swmr, backtests can read the files during the collection but only the recent candles are collected
+    await _run_jobs(jobs, _collect_symbol, batch_size, swmr)
+
+
+async def backfill_many(jobs: typing.List[typing.Tuple[typing.Union[BinanceClient, FtxClient], str, str]],
+                        batch_size: int = 10_000):
+    # Only request the candles missing between the stored ones
+    await _run_jobs(jobs, _backfill_symbol, batch_size)
+
+
+async def _run_jobs(jobs: typing.List[typing.Tuple[typing.Union[BinanceClient, FtxClient], str, str]],
+                    task: typing.Callable, batch_size: int, swmr: bool = False):
+    # Each exchange has one database client, one writer and one rate limiter shared by its symbols
+    writers = dict()
+    limiters = dict()
+
+    for _, exchange, _ in jobs:
+        if exchange not in writers:
+            h5_db = Hdf5Client(exchange)
+            if swmr:
+                h5_db.start_swmr([symbol for _, e, symbol in jobs if e == exchange])
+            writers[exchange] = CandleWriter(h5_db, batch_size)
+            limiters[exchange] = TokenBucket(*RATE_LIMITS.get(exchange, (1, 1)))
+
+    # A failed task cancels the other ones, so no candle is put after the writers are closed
+    errors = []
+    try:
+        async with asyncio.TaskGroup() as group:
+            for client, exchange, symbol in jobs:
+                group.create_task(task(client, exchange, symbol, writers[exchange], limiters[exchange]))
+    except ExceptionGroup as e:
+        # Same error as the failed task
+        raise e.exceptions[0]
+    finally:
+        # Every writer writes its buffered candles even if another one failed
+        for writer in writers.values():
+            try:
+                await asyncio.to_thread(writer.close)
+            except RuntimeError as e:
+                errors.append(e)
     
-    h5_db = Hdf5Client(exchange)
+    if len(errors) > 0:
+        raise errors[0]
+
+
+async def _get_historical_data(client: typing.Union[BinanceClient, FtxClient], limiter: TokenBucket, symbol: str,
+                               **kwargs) -> typing.Union[None, typing.List[typing.Tuple]]:
+    await limiter.acquire()
+    # The exchange clients are blocking, requests run in worker threads
+    return await asyncio.to_thread(client.get_historical_data, symbol, **kwargs)
+
+
+async def _collect_symbol(client: typing.Union[BinanceClient, FtxClient], exchange: str, symbol: str, writer: CandleWriter,
+                          limiter: TokenBucket):
+
+    h5_db = writer.h5_db
     h5_db.create_dataset(symbol)
-    
+
     oldest_ts, most_recent_ts = h5_db.get_first_last_timestamp(symbol)
-    
+
     # Initial Request
     if oldest_ts is None:
         # Minus 6000 because current candle is not finished (60 seconds but in miliseconds)
-        data = client.get_historical_data(symbol, end_time = int(time.time() * 1_000 - 6_000))
-    
+        data = await _get_historical_data(client, limiter, symbol, end_time = int(time.time() * 1_000 - 6_000))
+
         # Check if data
-        if len(data) == 0:
+        if data is None or len(data) == 0:
             logger.warning(f"{exchange}: {symbol}: No initial data found")
             return None
         else:
             format_input = (exchange, symbol, len(data), ms_to_dt(data[0][0]), ms_to_dt(data[-1][0]))
             logger.info("{}: {}: Collected {} intial data from {} to {}".format(*format_input))
-        
+
         # Update
         oldest_ts = data[0][0]
-        most_recent_ts = data[-1][0] 
+        most_recent_ts = data[-1][0]
         # Write Data
-        h5_db.write_data(symbol, data)
-    
-    data_to_insert = []
-    # Most Recent Data    
+        await asyncio.to_thread(writer.put, symbol, data)
+
+    # Most Recent Data
     while True:
-        data = client.get_historical_data(symbol, start_time = int(most_recent_ts + 6_0000))
+        data = await _get_historical_data(client, limiter, symbol, start_time = int(most_recent_ts + 6_0000))
         # In case an error occurs for the request
         if data is None:
-            time.sleep(4) 
+            await asyncio.sleep(4)
             continue
-        
+
         # To know if there is no more info to ask for
         if len(data)<2:
             break
-        
+
         # Don't take the last one cause it can be the unfinished current minute
         data = data[:-1]
-        
-        data_to_insert += data
-        
-        if len(data_to_insert) >= 10_000:
-            # Write Data
-            h5_db.write_data(symbol, data_to_insert)
-            data_to_insert.clear()
-            
-        
+
+        # Write Data
+        await asyncio.to_thread(writer.put, symbol, data)
+
         if data[-1][0] > most_recent_ts:
             most_recent_ts = data[-1][0]
-            
-        # Inform 
+
+        # Inform
         format_input = (exchange, symbol, len(data), ms_to_dt(data[0][0]), ms_to_dt(data[-1][0]))
         logger.info("{}: {}: Collected {} recent data from {} to {}".format(*format_input))
 
-        # Sleep so does not crash because of binance
-        time.sleep(1.1)
-        
-    # Write Data
-    h5_db.write_data(symbol, data_to_insert)
-    data_to_insert.clear()
-    
+    # The recent candles are written first, so a batch never spans the older and the recent ones
+    # (inserting it would read and rewrite every stored candle between them)
+    await asyncio.to_thread(writer.flush, symbol)
+
     # Older Data
-    while True:
-         data = client.get_historical_data(symbol, end_time = int(oldest_ts - 6_0000))
-         # In case an error occurs for the request
-         if data is None:
-             time.sleep(4) 
-             continue
-         
-         # To know if there is no more info to ask for
-         if len(data) == 0:
-             logger.info("{}: {}: Stopped older data data collection because no data was found before {}".format(exchange,
-                                                                                                                 symbol,
-                                                                                                                 ms_to_dt(oldest_ts)))
-             break
-         else:
-             data_to_insert += data
-             
-         if len(data_to_insert) >= 10_000:
+    # (inserting them would move the stored candles under the readers, so they are not collected in SWMR mode)
+    older = []
+    while not h5_db.hf.swmr_mode:
+        data = await _get_historical_data(client, limiter, symbol, end_time = int(oldest_ts - 6_0000))
+        # In case an error occurs for the request
+        if data is None:
+            await asyncio.sleep(4)
+            continue
+
+        # To know if there is no more info to ask for
+        if len(data) == 0:
+            logger.info("{}: {}: Stopped older data data collection because no data was found before {}".format(exchange,
+                                                                                                                symbol,
+                                                                                                                ms_to_dt(oldest_ts)))
+            break
+        else:
+            # Kept until the block is big enough
+            older.append(np.asarray(data, dtype = "float64").reshape(-1, 6))
+            if sum(len(d) for d in older) >= OLDER_BLOCK_ROWS:
+                await asyncio.to_thread(writer.put, symbol, np.concatenate(older))
+                older = []
+
+        # Check
+        if data[-1][0] < most_recent_ts:
+            oldest_ts = data[0][0]
+
+        # Inform
+        format_input = (exchange, symbol, len(data), ms_to_dt(data[0][0]), ms_to_dt(data[-1][0]))
+        logger.info("{}: {}: Collected {} older data from {} to {}".format(*format_input))
+
+    # Write the remaining candles before extending the cached bars
+    if len(older) > 0:
+        await asyncio.to_thread(writer.put, symbol, np.concatenate(older))
+    await asyncio.to_thread(writer.flush, symbol)
+
+    # Extend the cached bars with the new candles
+    for tf in RESAMPLED_TFS:
+        await asyncio.to_thread(h5_db.update_resampled, symbol, tf)
+
+    await _refresh_mmap(h5_db, symbol)
+
+
+async def _backfill_symbol(client: typing.Union[BinanceClient, FtxClient], exchange: str, symbol: str, writer: CandleWriter,
+                           limiter: TokenBucket):
+
+    h5_db = writer.h5_db
+    h5_db.create_dataset(symbol)
+
+    gaps = await asyncio.to_thread(h5_db.find_gaps, symbol)
+    logger.info("{}: {}: {} gaps found ({} missing candles)".format(exchange, symbol, len(gaps),
+                                                                     sum((end - start) // 60_000 + 1 for start, end in gaps)))
+
+    for gap_start, gap_end in gaps:
+        start_time = gap_start
+        while start_time <= gap_end:
+            data = await _get_historical_data(client, limiter, symbol, start_time = int(start_time), end_time = int(gap_end))
+            # In case an error occurs for the request
+            if data is None:
+                await asyncio.sleep(4)
+                continue
+
+            # The exchange has no candle there (outage), the gap can not be filled
+            data = [d for d in data if gap_start <= d[0] <= gap_end]
+            if len(data) == 0:
+                logger.info("{}: {}: No data found from {} to {}".format(exchange, symbol, ms_to_dt(start_time), ms_to_dt(gap_end)))
+                break
+
             # Write Data
-            h5_db.write_data(symbol, data_to_insert)
-            data_to_insert.clear()
-            
-        
-         # Check
-         if data[-1][0] < most_recent_ts:
-             oldest_ts = data[0][0]
-             
-         # Inform 
-         format_input = (exchange, symbol, len(data), ms_to_dt(data[0][0]), ms_to_dt(data[-1][0]))
-         logger.info("{}: {}: Collected {} older data from {} to {}".format(*format_input))
-         
-         # Sleep so does not crash because of binance
-         time.sleep(1.1)
-    # Write Data
-    h5_db.write_data(symbol, data_to_insert)
-    
-    
-    
-    
-    
+            await asyncio.to_thread(writer.put, symbol, data)
+            start_time = data[-1][0] + 60_000
+
+            # Inform
+            format_input = (exchange, symbol, len(data), ms_to_dt(data[0][0]), ms_to_dt(data[-1][0]))
+            logger.info("{}: {}: Collected {} missing data from {} to {}".format(*format_input))
+
+    # Write the remaining candles before rebuilding the cached bars
+    await asyncio.to_thread(writer.flush, symbol)
+
+    for tf in RESAMPLED_TFS:
+        await asyncio.to_thread(h5_db.update_resampled, symbol, tf)
+
+    await _refresh_mmap(h5_db, symbol)
+
+
+async def _refresh_mmap(h5_db: Hdf5Client, symbol: str):
+    # Memory-mapped exports of the symbol (if any) are rewritten so backtests keep using them
+    mmap_db = MmapClient(h5_db.exchange)
+    tfs = [tf for tf in MMAP_TFS if mmap_db.get_metadata(symbol, tf) is not None]
+
+    if len(tfs) > 0:
+        await asyncio.to_thread(h5_db.export_mmap, symbol, tfs)
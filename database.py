@@ -8,67 +8,372 @@ import numpy as np
 import logging
 import pandas as pd
 import time
+import os
+import json
+from utils import resample_array, TF_MS, RESAMPLED_TFS
+
+# Blosc / LZ4 filters are only available with the optional hdf5plugin package
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 logger = logging.getLogger()
 
-class Hdf5Client:
+# One week of 1m candles per chunk (~480 KB uncompressed): a time range read touches few chunks
+DEFAULT_CHUNK_ROWS = 10_080
+COMPRESSIONS = [None, "gzip", "lzf", "blosc", "lz4"]
+# Rows moved at once when candles are inserted before stored ones
+SHIFT_ROWS = 1_000_000
+# Timeframes written by Hdf5Client.export_mmap
+MMAP_TFS = ["1m"] + RESAMPLED_TFS
+# "a": read / write, the process has the file for itself (a writer can let readers in with start_swmr)
+# "r": read only, can follow a writer in SWMR mode (single writer / multiple readers)
+MODES = ["a", "r"]
+# Seconds a reader waits for another process building the cached bars (see open_reader)
+READER_WAIT = 30
+
+
+def dataset_options(chunk_rows: int = DEFAULT_CHUNK_ROWS, compression: typing.Optional[str] = None) -> typing.Dict:
+    # Keyword arguments of create_dataset for the candles layout
+    options = {"chunks": (chunk_rows, 6)}
+    
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, choose among {COMPRESSIONS}")
+    
+    if compression == "gzip":
+        options.update(compression = "gzip", compression_opts = 4, shuffle = True)
+    elif compression == "lzf":
+        options.update(compression = "lzf", shuffle = True)
+    elif compression in ["blosc", "lz4"]:
+        if hdf5plugin is None:
+            raise ValueError(f"{compression} compression requires the hdf5plugin package")
+        if compression == "blosc":
+            options.update(hdf5plugin.Blosc(cname = "lz4", clevel = 5, shuffle = hdf5plugin.Blosc.SHUFFLE))
+        else:
+            options.update(hdf5plugin.LZ4())
+            
+    return options
+
+
+def candles_to_dataframe(data: np.ndarray) -> pd.DataFrame:
+    df = pd.DataFrame(data, columns = ["timestamp", "open", "high", "low", "close", "volume"])
+    
+    df["timestamp"] = pd.to_datetime(df["timestamp"].values.astype(np.int64), unit = "ms")
+    df.set_index("timestamp", drop = True, inplace = True)
+    
+    return df
+
+
+def sort_unique(data: np.ndarray) -> np.ndarray:
+    # Rows sorted by timestamp, the first row of each timestamp is kept
+    data = data[np.argsort(data[:, 0], kind = "stable")]
+    keep = np.ones(len(data), dtype = bool)
+    keep[1:] = data[1:, 0] != data[:-1, 0]
+    
+    return data[keep]
+
+
+def open_reader(exchange: str, symbol: str, tf: typing.Optional[str] = None) -> "Hdf5Client":
+    """
+    Reader client (mode "r"), so backtests can run while a collector writes the file.
+    Opening a reader can write the file, since the reader itself never writes:
+    - candles of older versions are sorted once and an append mode client is returned;
+    - a missing or outdated cache of tf is built in append mode before the reader is opened,
+      when no other process has the file open (otherwise the bars missing from the cache
+      are resampled from the candles at each read)
+    """
+    h5_db = _open_client(exchange, "r")
+    
+    # Candles of older versions are sorted once in append mode (start_swmr sorts them, so no SWMR writer is running)
+    if symbol in h5_db.hf and not h5_db.dataset(symbol).attrs.get("sorted", False):
+        h5_db.hf.close()
+        try:
+            return _open_client(exchange, "a")
+        except OSError as e:
+            raise ValueError(f"{symbol} candles are not sorted and data/{exchange}.h5 stays open in another process, "
+                             f"close it so they can be sorted") from e
+    
+    if symbol in h5_db.hf and tf in RESAMPLED_TFS and h5_db.resampled_outdated(symbol, tf):
+        h5_db.hf.close()
+        try:
+            writer = Hdf5Client(exchange)
+        except OSError:
+            logger.info("data/%s.h5 is open in another process, the %s %s bars missing from the cache are resampled", exchange,
+                        symbol, tf)
+        else:
+            try:
+                writer.update_resampled(symbol, tf)
+            finally:
+                writer.hf.close()
+        h5_db = _open_client(exchange, "r")
+    
+    return h5_db
+
+
+def _open_client(exchange: str, mode: str) -> "Hdf5Client":
+    # The file is locked while another process builds cached bars in append mode, the client waits for it
+    for attempt in range(READER_WAIT):
+        try:
+            return Hdf5Client(exchange, mode = mode)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            if attempt == READER_WAIT - 1:
+                raise
+            time.sleep(1)
+
+
+def open_bars_source(exchange: str, symbol: str, tf: str) -> typing.Union["MmapClient", "Hdf5Client"]:
+    # The memory-mapped export is used when it was written from the current HDF5 data
+    h5_db = open_reader(exchange, symbol, tf)
+    mmap_db = MmapClient(exchange)
+    
+    metadata = mmap_db.get_metadata(symbol, tf)
+    if metadata is not None and symbol in h5_db.hf:
+        first_ts, last_ts = h5_db.get_first_last_timestamp(symbol)
+        if [metadata["first_ts"], metadata["last_ts"], metadata["row_count"]] == [first_ts, last_ts, h5_db.rows(h5_db.dataset(symbol))]:
+            return mmap_db
+        logger.info("Memory-mapped %s %s bars are outdated, reading the HDF5 file", symbol, tf)
+        
+    return h5_db
+
+
+def _save_npy(path: str, data: np.ndarray):
+    # Replace the file in one step so readers never map a partially written file
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, data)
+    os.replace(path + ".tmp", path)
+
+
+class MmapClient:
+    
+    """
+    Read only access to the bars exported by Hdf5Client.export_mmap. Each
+    timeframe is stored as a timestamp column and a column-major OHLCV file,
+    memory-mapped so the DataFrames are views of the OS page cache shared by
+    every process
+    """
     
     def __init__(self, exchange: str):
-        self.hf = h5py.File(f"data/{exchange}.h5", mode = "a") # Append Data
-        # Flush to skip errors
-        self.hf.flush()
+        self.path = f"data/{exchange}"
+        
+        
+    def directory(self, symbol: str, tf: str) -> str:
+        return os.path.join(self.path, symbol, tf)
+    
+    
+    def get_metadata(self, symbol: str, tf: str) -> typing.Union[None, typing.Dict]:
+        path = os.path.join(self.directory(symbol, tf), "metadata.json")
+        
+        if not os.path.exists(path):
+            return None
+        
+        with open(path) as f:
+            return json.load(f)
+        
+        
+    def get_resampled_data(self, symbol: str, tf: str, from_time: int, to_time: int) -> typing.Union[None, pd.DataFrame]:
+        start_query = time.time()
+        
+        directory = self.directory(symbol, tf)
+        timestamps = np.load(os.path.join(directory, "timestamp.npy"), mmap_mode = "r")
+        ohlcv = np.load(os.path.join(directory, "ohlcv.npy"), mmap_mode = "r")
+        
+        if len(timestamps) == 0:
+            return None
+        
+        # Same window as Hdf5Client.get_resampled_data: the bar containing from_time is included
+        start = np.searchsorted(timestamps, from_time - from_time % TF_MS[tf], side = "left")
+        end = np.searchsorted(timestamps, to_time, side = "right")
+        
+        index = pd.DatetimeIndex(np.asarray(timestamps[start:end]).view("datetime64[ms]"), name = "timestamp")
+        # No copy of the candles: the DataFrame is a read only view of the mapped file
+        df = pd.DataFrame(ohlcv[start:end], index = index, columns = ["open", "high", "low", "close", "volume"], copy = False)
+        
+        query_time = time.time() - start_query
+        
+        logger.info("Mapped %s %s %s bars in %s seconds", len(df), symbol, tf, query_time)
+        
+        return df
+
+
+class Hdf5Client:
+    
+    def __init__(self, exchange: str, chunk_rows: int = DEFAULT_CHUNK_ROWS, compression: typing.Optional[str] = None,
+                 mode: str = "a"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, choose among {MODES}")
+        
+        self.exchange = exchange
+        self.mode = mode
+        
+        # Bigger chunk cache so the binary searches and range reads do not decompress a chunk twice
+        if mode == "r":
+            # Readers never write, they see the candles appended by a SWMR writer when they refresh the datasets
+            self.hf = h5py.File(f"data/{exchange}.h5", mode = "r", libver = "latest", swmr = True, rdcc_nbytes = 32 * 1024 ** 2)
+            # Only files in the latest format (superblock 3) can have a SWMR writer, the older ones are never refreshed
+            # (refreshing them breaks the other handles of the dataset)
+            self._refresh = self.hf.id.get_create_plist().get_version()[0] >= 3
+            # One handle per dataset: refreshing a handle breaks the reads of the other handles of the same dataset
+            self._datasets = dict()
+        else:
+            # The latest file format (HDF5 >= 1.10) is needed by the SWMR mode
+            self.hf = h5py.File(f"data/{exchange}.h5", mode = "a", libver = "latest", rdcc_nbytes = 32 * 1024 ** 2) # Append Data
+            # Flush to skip errors
+            self.hf.flush()
+        # Layout of the new datasets
+        self.dataset_options = dataset_options(chunk_rows, compression)
+        
+        
+    def dataset(self, name: str) -> h5py.Dataset:
+        if self.mode != "r":
+            return self.hf[name]
+        
+        # A reader refreshes the dataset to see the rows appended by the writer since the last read
+        if name not in self._datasets:
+            self._datasets[name] = self.hf[name]
+        if self._refresh:
+            self._datasets[name].refresh()
+        
+        return self._datasets[name]
+    
+    
+    def rows(self, dataset: h5py.Dataset) -> int:
+        # Rows a reader can use: a SWMR writer resizes a dataset before writing the new rows, so a reader refreshing
+        # in between sees rows of fill values (timestamp 0) at the end. They are a suffix of the sorted rows
+        size = dataset.shape[0]
+        if self.mode != "r" or size == 0 or dataset[size - 1, 0] != 0:
+            return size
+        
+        low, high = 0, size - 1
+        while low < high:
+            middle = (low + high) // 2
+            if dataset[middle, 0] == 0:
+                high = middle
+            else:
+                low = middle + 1
+                
+        return low
+    
+    
+    def start_swmr(self, symbols: typing.List[str]):
+        """
+        Let readers (mode "r") open the file while this client writes it. In SWMR mode
+        the writer can only append rows to existing datasets, so the datasets of the
+        symbols are created, sorted and their cached bars built before it starts.
+        From then on, write_data only appends candles newer than the stored ones
+        and the cached bars are not extended (readers resample the newer candles)
+        """
+        if self.mode != "a":
+            raise ValueError("Only a client opened in append mode can write in SWMR mode")
+        
+        for symbol in symbols:
+            self.create_dataset(symbol)
+            if self.dataset(symbol).shape[0] > 0:
+                self.sort_dataset(symbol)
+                self.get_first_last_timestamp(symbol)
+            for tf in RESAMPLED_TFS:
+                self.update_resampled(symbol, tf)
+        
+        try:
+            self.hf.swmr_mode = True
+        except RuntimeError as e:
+            raise ValueError(f"data/{self.exchange}.h5 was created without SWMR support, rewrite it with migrate.py") from e
+        
+        logger.info("%s: SWMR mode started, readers can open the file", self.exchange)
         
         
     def create_dataset(self, symbol: str):
         if symbol not in self.hf.keys():
-            self.hf.create_dataset(symbol, (0,6), maxshape = (None, 6), dtype = "float64")
+            if self.hf.swmr_mode:
+                raise ValueError(f"No {symbol} dataset, it must be created before the SWMR mode starts")
+            self.hf.create_dataset(symbol, (0,6), maxshape = (None, 6), dtype = "float64", **self.dataset_options)
+            # Rows are kept sorted by timestamp so time ranges can be found with a binary search
+            self.hf[symbol].attrs["sorted"] = True
             
             
-    def write_data(self, symbol: str, data: typing.List[typing.Tuple]):
+    def write_data(self, symbol: str, data: typing.Union[np.ndarray, typing.List[typing.Tuple]]):
+        # Insert candles at their place (recent, older or inside gaps) so the dataset stays sorted and unique
+        dataset = self.dataset(symbol)
+        self.sort_dataset(symbol)
         
-        oldest_ts, most_recent_ts = self.get_first_last_timestamp(symbol)
+        data_array = np.asarray(data, dtype = "float64").reshape(-1, 6)
         
-        if oldest_ts is None:
-            oldest_ts = float("inf")
-            most_recent_ts = 0             
+        # Order data and drop repeated timestamps
+        data_array = sort_unique(data_array)
+        
+        if data_array.shape[0] == 0:
+            logger.warning(f"[+] No data to insert for {symbol}")
+            return
+        
+        if self.hf.swmr_mode:
+            self._append_data(symbol, data_array)
+            return
         
-        filtered_data = []
-        # Order data and filter
-        for d in data:
-            if d[0] < oldest_ts:
-                filtered_data.append(d)
-            elif d[0] > most_recent_ts:
-                filtered_data.append(d)
+        # Stored rows inside the time range of the new candles
+        size = dataset.shape[0]
+        start = self._search_timestamp(dataset, data_array[0, 0], False)
+        end = self._search_timestamp(dataset, data_array[-1, 0], True)
+        existing = dataset[start:end]
         
-        if len(filtered_data) == 0:
+        # Drop the candles already stored
+        data_array = data_array[~np.isin(data_array[:, 0], existing[:, 0], assume_unique = True)]
+        
+        if data_array.shape[0] == 0:
             logger.warning(f"[+] No data to insert for {symbol}")
             return
         
-        data_array = np.array(data)
+        merged = np.concatenate([existing, data_array])
+        merged = merged[np.argsort(merged[:, 0], kind = "stable")]
+        inserted = data_array.shape[0]
+        
+        dataset.resize(size + inserted, axis = 0)
         
-        self.hf[symbol].resize(self.hf[symbol].shape[0] + data_array.shape[0], axis = 0) 
-        self.hf[symbol][-data_array.shape[0]:] = data_array
+        # Move the later rows to make room, from the end so no row is overwritten before being read
+        for block_end in range(size, end, -SHIFT_ROWS):
+            block_start = max(end, block_end - SHIFT_ROWS)
+            dataset[block_start + inserted:block_end + inserted] = dataset[block_start:block_end]
+            
+        dataset[start:end + inserted] = merged
+        
+        self._set_metadata(symbol, dataset[0, 0], dataset[-1, 0])
         # Flush
         self.hf.flush()
+        
+        
+    def _append_data(self, symbol: str, data_array: np.ndarray):
+        # SWMR mode: moving the stored rows would show torn data to the readers, so only newer candles are written
+        dataset = self.dataset(symbol)
+        size = dataset.shape[0]
+        
+        if size > 0:
+            older = data_array[:, 0] <= dataset[-1, 0]
+            if older.any():
+                logger.warning("%s: %s candles older than the stored ones are not written in SWMR mode", symbol, int(older.sum()))
+            data_array = data_array[~older]
+        
+        if data_array.shape[0] == 0:
+            return
+        
+        dataset.resize(size + data_array.shape[0], axis = 0)
+        dataset[size:] = data_array
+        # The attributes are not updated (readers take the first and last rows), flush makes the rows visible
+        self.hf.flush()
     
     
     def get_data(self, symbol:str, from_time: int, to_time:int) -> typing.Union[None, pd.DataFrame]:
         
         start_query = time.time()
         
-        existing_data = self.hf[symbol][:]
-        
-        if len(existing_data) == 0:
+        if self.rows(self.dataset(symbol)) == 0:
             return None
         
-        data = sorted(existing_data, key = lambda x:x[0])
-        data = np.array(data)
-        
-        df = pd.DataFrame(data, columns = ["timestamp", "open", "high", "low", "close", "volume"])
-        df = df[(df["timestamp"] >= from_time) & (df["timestamp"] >= from_time)]
+        self.sort_dataset(symbol)
         
-        df["timestamp"] = pd.to_datetime(df["timestamp"].values.astype(np.int64), unit = "ms")
-        df.set_index("timestamp", drop = True, inplace = True)
+        # Only the rows of the time range are read from the file
+        start, end = self._time_range(symbol, from_time, to_time)
+        df = candles_to_dataframe(self.dataset(symbol)[start:end])
         
         query_time = time.time() - start_query
         
@@ -77,13 +382,252 @@ class Hdf5Client:
         return df
     
     
+    def find_gaps(self, symbol: str, from_time: int = 0, to_time: typing.Optional[int] = None,
+                  candle_ms: int = 60_000) -> typing.List[typing.Tuple[int, int]]:
+        # Missing candles between the stored ones, as (first missing, last missing) timestamps
+        if self.rows(self.dataset(symbol)) == 0:
+            return []
+        
+        self.sort_dataset(symbol)
+        start, end = self._time_range(symbol, from_time, float("inf") if to_time is None else to_time)
+        timestamps = self.dataset(symbol)[start:end, 0]
+        
+        holes = np.flatnonzero(np.diff(timestamps) > candle_ms)
+        
+        return [(int(timestamps[i] + candle_ms), int(timestamps[i + 1] - candle_ms)) for i in holes]
+    
+    
+    def count_candles(self, symbol: str, to_time: float) -> int:
+        # Candles up to to_time: another count for the same time tells candles were inserted before it
+        self.sort_dataset(symbol)
+        return self._search_timestamp(self.dataset(symbol), to_time, True)
+    
+    
+    def get_resampled_data(self, symbol: str, tf: str, from_time: int, to_time: int) -> typing.Union[None, pd.DataFrame]:
+        # Bars of the timeframe read from the cache, the bar containing from_time is included
+        start_query = time.time()
+        
+        if symbol not in self.hf or self.rows(self.dataset(symbol)) == 0:
+            return None
+        
+        df = candles_to_dataframe(self._resampled_bars(symbol, tf, from_time - from_time % TF_MS[tf], to_time))
+        
+        query_time = time.time() - start_query
+        
+        logger.info("Retrieved %s %s %s bars from database in %s seconds", len(df), symbol, tf, query_time)
+        
+        return df
+    
+    
+    def _resampled_bars(self, symbol: str, tf: str, from_time: int, to_time: int) -> np.ndarray:
+        # Bars from from_time (start of a bar) to to_time
+        if tf == "1m":
+            # Not cached, the candles of the window are resampled to add the missing minutes
+            return self._resample_window(symbol, tf, from_time, to_time)
+        
+        if not self.hf.swmr_mode:
+            self.update_resampled(symbol, tf)
+        
+        name = f"resampled/{symbol}/{tf}"
+        raw = self.dataset(symbol)
+        bars = self.dataset(name) if name in self.hf else None
+        
+        if bars is None or bars.shape[0] == 0 or not self._cache_extendable(raw, bars, self.get_first_last_timestamp(symbol)[0]):
+            return self._resample_window(symbol, tf, from_time, to_time)
+        
+        # In SWMR mode candles can be appended after the cache was built: its last bar may be incomplete,
+        # so the bars from the last one are resampled from the candles
+        complete = bars.shape[0] if bars.attrs["raw_rows"] == self.rows(raw) else bars.shape[0] - 1
+        
+        start = self._search_timestamp(bars, from_time, False)
+        end = self._search_timestamp(bars, to_time, True)
+        cached = bars[start:min(end, complete)]
+        
+        if end <= complete:
+            return cached
+        
+        return np.concatenate([cached, self._resample_window(symbol, tf, max(from_time, bars[complete, 0]), to_time)])
+    
+    
+    def _resample_window(self, symbol: str, tf: str, from_time: int, to_time: int) -> np.ndarray:
+        # Bars from from_time (start of a bar) to to_time computed from the candles
+        self.sort_dataset(symbol)
+        # Every candle of the bar containing to_time
+        start, end = self._time_range(symbol, from_time, to_time - to_time % TF_MS[tf] + TF_MS[tf] - 1)
+        # The candles around the window are included so missing bars at its edges are filled too
+        raw = self.dataset(symbol)
+        bars = resample_array(raw[max(start - 1, 0):min(end + 1, self.rows(raw))], tf)
+        
+        return bars[(bars[:, 0] >= from_time) & (bars[:, 0] <= to_time)]
+    
+    
+    def resampled_outdated(self, symbol: str, tf: str) -> bool:
+        # True if update_resampled would build or extend the cached bars of the timeframe
+        raw = self.dataset(symbol)
+        name = f"resampled/{symbol}/{tf}"
+        
+        if self.rows(raw) == 0:
+            return False
+        if name not in self.hf:
+            return True
+        
+        bars = self.dataset(name)
+        return bars.shape[0] == 0 or bars.attrs["raw_rows"] != self.rows(raw) or \
+            not self._cache_extendable(raw, bars, self.get_first_last_timestamp(symbol)[0])
+    
+    
+    def _cache_extendable(self, raw: h5py.Dataset, bars: h5py.Dataset, first_ts: float) -> bool:
+        # True if no candle was inserted before or inside the range the cached bars were built from
+        return bars.attrs["raw_first_ts"] == first_ts and self._search_timestamp(raw, bars.attrs["raw_last_ts"], True) == bars.attrs["raw_rows"]
+    
+    
+    def update_resampled(self, symbol: str, tf: str):
+        # Keep the cached bars of the timeframe in line with the 1m candles
+        raw = self.dataset(symbol)
+        
+        # In SWMR mode the cache stays as it was when the mode started
+        if raw.shape[0] == 0 or self.hf.swmr_mode:
+            return
+        
+        self.sort_dataset(symbol)
+        first_ts, last_ts = self.get_first_last_timestamp(symbol)
+        
+        name = f"resampled/{symbol}/{tf}"
+        if name not in self.hf:
+            self.hf.create_dataset(name, (0, 6), maxshape = (None, 6), dtype = "float64", **self.dataset_options)
+        bars = self.hf[name]
+        
+        # The cache can be extended if no candle was inserted before or inside the range it was built from
+        extend = bars.shape[0] > 0 and self._cache_extendable(raw, bars, first_ts)
+        
+        if extend:
+            if bars.attrs["raw_rows"] == raw.shape[0]:
+                return
+            # The last bar may have been incomplete, so it is computed again with the new candles
+            start_bar = bars.shape[0] - 1
+            start_raw = self._search_timestamp(raw, bars[start_bar, 0], False)
+        else:
+            start_bar = 0
+            start_raw = 0
+        
+        start_resample = time.time()
+        
+        new_bars = resample_array(raw[start_raw:], tf)
+        
+        bars.resize(start_bar + new_bars.shape[0], axis = 0)
+        bars[start_bar:] = new_bars
+        
+        bars.attrs["raw_first_ts"] = first_ts
+        bars.attrs["raw_last_ts"] = last_ts
+        bars.attrs["raw_rows"] = raw.shape[0]
+        self.hf.flush()
+        
+        logger.info("%s %s %s bars from %s candles in %s seconds", "Extended" if extend else "Built", symbol, tf,
+                    raw.shape[0] - start_raw, time.time() - start_resample)
+    
+    
+    def export_mmap(self, symbol: str, tfs: typing.List[str] = MMAP_TFS):
+        # Write the bars of each timeframe as memory-mappable files for MmapClient
+        first_ts, last_ts = self.get_first_last_timestamp(symbol)
+        
+        if first_ts is None:
+            return
+        
+        mmap_db = MmapClient(self.exchange)
+        
+        for tf in tfs:
+            start_export = time.time()
+            
+            # Missing bars are added as NaN bars, like get_resampled_data
+            bars = self._resampled_bars(symbol, tf, first_ts - first_ts % TF_MS[tf], last_ts)
+            
+            directory = mmap_db.directory(symbol, tf)
+            os.makedirs(directory, exist_ok = True)
+            
+            _save_npy(os.path.join(directory, "timestamp.npy"), bars[:, 0].astype(np.int64))
+            # Column-major: each column is contiguous on disk
+            _save_npy(os.path.join(directory, "ohlcv.npy"), np.asfortranarray(bars[:, 1:]))
+            
+            # Written last: it tells which HDF5 data the files were built from
+            with open(os.path.join(directory, "metadata.json.tmp"), "w") as f:
+                json.dump({"first_ts": float(first_ts), "last_ts": float(last_ts), "row_count": self.dataset(symbol).shape[0]}, f)
+            os.replace(os.path.join(directory, "metadata.json.tmp"), os.path.join(directory, "metadata.json"))
+            
+            logger.info("Exported %s %s %s bars in %s seconds", len(bars), symbol, tf, time.time() - start_export)
+        
+        
+    def sort_dataset(self, symbol: str):
+        # Rewrite the dataset sorted by timestamp (files written before the inserts were kept sorted)
+        dataset = self.dataset(symbol)
+        
+        if dataset.attrs.get("sorted", False):
+            return
+        
+        if self.hf.swmr_mode:
+            raise ValueError(f"{symbol} candles are not sorted, open the file in append mode once to sort them")
+        
+        start_sort = time.time()
+        
+        # Older versions could also write the same candle twice
+        existing_data = sort_unique(dataset[:])
+        
+        dataset.resize(existing_data.shape[0], axis = 0)
+        dataset[:] = existing_data
+        dataset.attrs["sorted"] = True
+        if existing_data.shape[0] > 0:
+            self._set_metadata(symbol, existing_data[0, 0], existing_data[-1, 0])
+        self.hf.flush()
+        
+        logger.info("Sorted %s %s rows in %s seconds", len(existing_data), symbol, time.time() - start_sort)
+    
+    
+    def _time_range(self, symbol: str, from_time: int, to_time: int) -> typing.Tuple[int, int]:
+        # Indexes of the first row >= from_time and of the first row > to_time
+        dataset = self.dataset(symbol)
+        
+        return self._search_timestamp(dataset, from_time, False), self._search_timestamp(dataset, to_time, True)
+    
+    
+    def _search_timestamp(self, dataset: h5py.Dataset, timestamp: float, right: bool) -> int:
+        # Binary search on the sorted timestamp column, reading one value from disk per step
+        low, high = 0, self.rows(dataset)
+        
+        while low < high:
+            middle = (low + high) // 2
+            value = dataset[middle, 0]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+                
+        return low
+    
+    
     def get_first_last_timestamp(self, symbol: str) -> typing.Union[typing.Tuple[None, None], typing.Tuple[float, float]]:
-        existing_data = self.hf[symbol][:]
+        dataset = self.dataset(symbol)
+        rows = self.rows(dataset)
         
-        if len(existing_data) == 0:
+        if rows == 0:
             return None, None
         
-        first_ts = min(existing_data[:, 0]) # min(existing_data, key = lambda x:x[0])[0]
-        last_ts = max(existing_data[:, 0]) # max(existing_data, key = lambda x:x[0])[0]
+        # The attributes are only trusted if they describe the current number of rows
+        # (files from older versions or a crash between the resize and the update are scanned once)
+        if dataset.attrs.get("row_count") != rows:
+            if self.hf.swmr_mode:
+                # Not written in SWMR mode: the candles were sorted before it started and are only appended
+                self.sort_dataset(symbol)
+                return dataset[0, 0], dataset[rows - 1, 0]
+
+            timestamps = dataset[:, 0]
+            self._set_metadata(symbol, timestamps.min(), timestamps.max())
+            self.hf.flush()
         
-        return first_ts, last_ts
\ No newline at end of file
+        return dataset.attrs["first_ts"], dataset.attrs["last_ts"]
+    
+    
+    def _set_metadata(self, symbol: str, first_ts: float, last_ts: float):
+        # Written after the rows, row_count last so a partial update is detected on the next read
+        dataset = self.hf[symbol]
+        dataset.attrs["first_ts"] = first_ts
+        dataset.attrs["last_ts"] = last_ts
+        dataset.attrs["row_count"] = dataset.shape[0]
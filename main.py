@@ -1,10 +1,12 @@
 # logging provides a flexible framework for emitting log messages from Python programs
 import logging
 import datetime
+import os
 from exchanges.binance import BinanceClient
 from exchanges.ftx import FtxClient
-from data_collector import collect_all
+from data_collector import collect_symbols, backfill_symbols
 from utils import TF_EQUIV
+from registry import STRATEGIES
 import backtester, optimizer
 import pandas as pd
 
@@ -41,8 +43,8 @@ logger.addHandler(file_handler)
 if __name__ == '__main__':
     # Mode
     while True:
-        mode = input("Choose the program code (data / backtest / optimize): ").lower()
-        if mode in ["data", "backtest", "optimize"]:
+        mode = input("Choose the program code (data / backfill / backtest / optimize): ").lower()
+        if mode in ["data", "backfill", "backtest", "optimize"]:
             break
     # Select exchanges
     while True:
@@ -61,22 +63,41 @@ if __name__ == '__main__':
         # print(client.get_historical_data("BTC-PERP"))
     
     while True:
-        symbol = input("Choose a symbol: " + "(" + " / ".join(client.symbols) + "): ").upper()
-        if symbol in client.symbols:
+        # Several symbols separated by commas can be collected at once
+        symbols = input("Choose a symbol: " + "(" + " / ".join(client.symbols) + "): ").upper().replace(" ", "").split(",")
+        if all(s in client.symbols for s in symbols) and (mode in ["data", "backfill", "optimize"] or len(symbols) == 1):
             break
+    symbol = symbols[0]
         
     if mode == "data":
-        collect_all(client, exchange, symbol)
+        # SWMR: backtests can read the file during the collection, only the candles newer than the stored ones are collected
+        swmr = input("Let backtests read the data during the collection (y / n): ").lower() == "y"
+        collect_symbols(client, exchange, symbols, swmr = swmr)
+    
+    elif mode == "backfill":
+        # Fill the holes of the stored data (exchange outages, crashed runs)
+        backfill_symbols(client, exchange, symbols)
         
     elif mode in ["backtest", "optimize"]:
         # Strategies
-        strategies = ["obv", "ichimoku", "sup_res"]
+        strategies = list(STRATEGIES)
         # Choose one
         while True:
             stra = input(f"Choose a strategy ({' / '.join(strategies)}): ").lower()
             if stra in strategies:
                 break
 
+        # Trading costs of the strategies that simulate their trades
+        options = dict()
+        for option in STRATEGIES[stra].option_names:
+            while True:
+                try:
+                    value = input(f"{option.capitalize()} (fraction of the price, Enter = 0): ")
+                    options[option] = float(value) if value != "" else 0.0
+                    break
+                except ValueError:
+                    continue
+
         # Choose timeframe
         while True:
             tf = input(f"Choose a timeframe: ({' / '.join(TF_EQUIV.keys())}): ").lower()
@@ -109,7 +130,7 @@ if __name__ == '__main__':
                     continue
         if mode == "backtest":
             # Backtest
-            print(backtester.run(exchange, symbol, stra, tf, from_time, to_time))
+            print(backtester.run(exchange, symbol, stra, tf, from_time, to_time, options = options))
             
         elif mode == "optimize":
             
@@ -128,69 +149,73 @@ if __name__ == '__main__':
                        break
                    except ValueError:
                        continue
-            # Nsga2
-            
-            # Initialize
-            nsga2 = optimizer.Nsga2(exchange, symbol, stra, tf, from_time, to_time, pop_size)
             
-            # Create Population
-            initial_population = nsga2.create_initial_population()
+            # Early stop
+            while True:
+                patience = input("Stop after how many generations without improvement of the front (Enter = never): ")
+                if patience == "":
+                    patience = None
+                    break
+                try:
+                    patience = int(patience)
+                    if patience >= 1:
+                        break
+                except ValueError:
+                    continue
+                   
+            # Successive halving of the offspring
+            while True:
+                fidelity = input("Screen the offspring on the last part of the window first, window:keep,... "
+                                 "(e.g. 0.1:0.3,0.3:0.5, Enter = whole window): ")
+                try:
+                    fidelity = optimizer.parse_fidelity(fidelity)
+                    break
+                except ValueError:
+                    continue
+                   
+            # Workers
+            while True:
+                try:
+                    workers = int(input("Choose a number of workers (1 = serial): "))
+                    if workers >= 1:
+                        break
+                except ValueError:
+                    continue
             
-            # Evaluate
-            evaluated_population = nsga2.evaluate_population(initial_population)
+            # The state is saved after every generation, an interrupted run can be continued
+            checkpoint_path = f"data/{exchange}_{'_'.join(symbols)}_{stra}_{tf}_checkpoint.pkl"
+            if os.path.exists(checkpoint_path):
+                while True:
+                    resume = input("Resume the previous optimization (y / n): ").lower()
+                    if resume in ["y", "n"]:
+                        break
+                if resume == "y":
+                    # Same window and population size as the interrupted run
+                    run = optimizer.read_checkpoint(checkpoint_path)["run"]
+                    from_time, to_time, pop_size = run["from_time"], run["to_time"], run["population_size"]
+                    options = run.get("options", options)
+                else:
+                    os.remove(checkpoint_path)
             
-            # Add crowding distance to see which are better
-            # This crowding distance will be used to create a new sample with the 
-            # best of two parents chosen randomly
-            p_population = nsga2.crowding_distance(evaluated_population)
+            # Nsga2
             
-            g = 0
-            while g < generations:
-                # Create an ofspring populatin. It is supposed to be better from 
-                # intial population, since it is taking the best from 2 parents
-                # chosen randomly.
-                
-                # Add offspring population (A "better" one)
-                q_population = nsga2.create_offspring_population(p_population)
-                
-                # Evaluate new offspring population
-                q_population = nsga2.evaluate_population(q_population)
-                
-                # Add populations
-                r_population = p_population + q_population
-                
-                # Remove previous params from strategies for new generation
-                nsga2.population_params.clear()
-                
-                # Reset all params except pnl and max_dd
-                # They will be reset because sample is now bigger and they must be
-                # computed again
-                i = 0
-                population = dict()
-                for bt in r_population:
-                    bt.reset_results()
-                    nsga2.population_params.append(bt.parameters)
-                    population[i] = bt
-                    i += 1
-
-                # Find non-dominated individuals (F1, F2, F3) according to its levels
-                # F1 Frontier dominates F2 Frontier, F2 Frontier dominates F3 Frontier, ... until non-dominated individuals are found
-                fronts = nsga2.non_dominated_sorting(population)
-                
-                # Get crowding distance of old population and the new "better" one
-                # but by fronts
-                for j in range(len(fronts)):
-                    fronts[j] = nsga2.crowding_distance(fronts[j])
-
-                p_population = nsga2.create_new_population(fronts)
-
-                
-                print(f"{float((g + 1)/generations)} %", end = "\n")
-                
-                g += 1
+            # Initialize
+            # Backtest results are cached on disk so a rerun over the same window is almost free
+            # Several symbols are optimized together as a basket (mean pnl, worst drawdown)
+            nsga2 = optimizer.Nsga2(exchange, symbols if len(symbols) > 1 else symbol, stra, tf, from_time, to_time, pop_size, workers,
+                                    cache_path = f"data/{exchange}_fitness_cache.pkl", fidelity = fidelity,
+                                    options = options)
             
-            print("\n")
+            # Run every generation
+            try:
+                p_population = nsga2.optimize(generations, checkpoint_path, patience = patience)
+            finally:
+                # Release worker processes and shared memory, also when the run is interrupted (Ctrl+C)
+                nsga2.close()
             
+            # Store the evaluated parameters for the next runs
+            nsga2.cache.save()
+            logger.info(nsga2.cache.stats())
                 
             # Print fronts
             for individual in p_population:
@@ -0,0 +1,125 @@
+# Rewrites the candles of an exchange file (data/{exchange}.h5) with a chunked / compressed layout
+# Example: python migrate.py binance --compression gzip --chunk-rows 10080
+# The previous file is kept as data/{exchange}.h5.bak
+# With --mmap the bars are also exported as memory-mapped files (data/{exchange}/{symbol}/{tf}/)
+# The new file uses the latest HDF5 format, so a collector can write it in SWMR mode while backtests read it
+
+import argparse
+import logging
+import os
+import time
+import typing
+import h5py
+from database import Hdf5Client, dataset_options, sort_unique, DEFAULT_CHUNK_ROWS, COMPRESSIONS
+
+logger = logging.getLogger()
+
+# Rows copied at once when the dataset is already sorted
+COPY_ROWS = 1_000_000
+
+
+def _drop_cache(path: str) -> bool:
+    # Evict the file from the OS page cache so the next read comes from the disk, False where it is not possible
+    if not hasattr(os, "posix_fadvise"):
+        return False
+
+    with open(path, "rb") as f:
+        # Pages not written to the disk yet are not evicted
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    return True
+
+
+def _read_throughput(dataset: h5py.Dataset) -> float:
+    # MB/s of uncompressed candles when reading the whole dataset
+    start = time.time()
+    for i in range(0, dataset.shape[0], COPY_ROWS):
+        dataset[i:i + COPY_ROWS]
+    elapsed = max(time.time() - start, 1e-9)
+
+    return dataset.shape[0] * 6 * 8 / 1024 ** 2 / elapsed
+
+
+def _copy_candles(old: h5py.Dataset, new_file: h5py.File, symbol: str, options: typing.Dict) -> h5py.Dataset:
+    if old.attrs.get("sorted", False):
+        new = new_file.create_dataset(symbol, (old.shape[0], 6), maxshape = (None, 6), dtype = "float64", **options)
+        for i in range(0, old.shape[0], COPY_ROWS):
+            new[i:i + COPY_ROWS] = old[i:i + COPY_ROWS]
+    else:
+        # Files from older versions may be unsorted or contain repeated candles, the new one never does
+        data = sort_unique(old[:])
+        new = new_file.create_dataset(symbol, (data.shape[0], 6), maxshape = (None, 6), dtype = "float64", **options)
+        new[:] = data
+
+    for key, value in old.attrs.items():
+        new.attrs[key] = value
+    new.attrs["sorted"] = True
+
+    return new
+
+
+def migrate(exchange: str, chunk_rows: int = DEFAULT_CHUNK_ROWS, compression: typing.Optional[str] = None) -> typing.List[typing.Dict]:
+    path = f"data/{exchange}.h5"
+    new_path = path + ".migrating"
+    backup_path = path + ".bak"
+
+    options = dataset_options(chunk_rows, compression)
+    report = []
+
+    with h5py.File(path, mode = "r") as old_file, h5py.File(new_path, mode = "w", libver = "latest") as new_file:
+        for name, old in old_file.items():
+            # Candles datasets get the new layout, anything else is copied as it is
+            if not isinstance(old, h5py.Dataset) or old.ndim != 2 or old.shape[1] != 6:
+                old_file.copy(old, new_file, name = name)
+                continue
+
+            _copy_candles(old, new_file, name, options)
+            report.append({"symbol": name, "rows": old.shape[0], "old_mb_s": None, "new_mb_s": None})
+
+    # Both files were just read / written: the reads are timed on a separate pass once they are out of the page cache,
+    # otherwise only the size change is reported
+    if _drop_cache(path) and _drop_cache(new_path):
+        with h5py.File(path, mode = "r") as old_file, h5py.File(new_path, mode = "r") as new_file:
+            for r in report:
+                r["old_mb_s"] = _read_throughput(old_file[r["symbol"]])
+                r["new_mb_s"] = _read_throughput(new_file[r["symbol"]])
+
+    old_size = os.path.getsize(path)
+    new_size = os.path.getsize(new_path)
+
+    os.replace(path, backup_path)
+    os.replace(new_path, path)
+
+    logger.info("%s: %s MB -> %s MB (%s %% of the previous size), previous file kept as %s", exchange,
+                round(old_size / 1024 ** 2, 2), round(new_size / 1024 ** 2, 2), round(new_size / max(old_size, 1) * 100, 2),
+                backup_path)
+    for r in report:
+        if r["old_mb_s"] is None:
+            logger.info("%s: %s rows (read throughput not measured, the files can not be evicted from the page cache)",
+                        r["symbol"], r["rows"])
+        else:
+            logger.info("%s: %s rows, cold full read %s MB/s -> %s MB/s", r["symbol"], r["rows"],
+                        round(r["old_mb_s"], 2), round(r["new_mb_s"], 2))
+
+    return report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s :: %(message)s")
+
+    parser = argparse.ArgumentParser(description = "Rewrite an exchange HDF5 file with a chunked / compressed layout")
+    parser.add_argument("exchanges", nargs = "+", help = "Exchanges to migrate (ftx / binance)")
+    parser.add_argument("--chunk-rows", type = int, default = DEFAULT_CHUNK_ROWS, help = "Candles per chunk")
+    parser.add_argument("--mmap", action = "store_true", help = "Also export every symbol as memory-mapped files for backtests")
+    parser.add_argument("--compression", choices = [c for c in COMPRESSIONS if c is not None], default = None,
+                        help = "Compression filter (blosc and lz4 need hdf5plugin)")
+    args = parser.parse_args()
+
+    for exchange in args.exchanges:
+        report = migrate(exchange.lower(), args.chunk_rows, args.compression)
+
+        if args.mmap:
+            h5_db = Hdf5Client(exchange.lower())
+            for r in report:
+                h5_db.export_mmap(r["symbol"])
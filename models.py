@@ -1,3 +1,6 @@
+import typing
+import numpy as np
+
 
 
 class BacktestResult:
@@ -21,3 +24,35 @@ class BacktestResult:
         self.rank = 0
         self.crowding_distance = 0.0
     
+
+
+
+class Population:
+    
+    """
+    Columnar population: one row per individual so the parent selection
+    and the offspring creation run on NumPy arrays
+    """
+    
+    def __init__(self, params_data: typing.Dict, params: np.ndarray, pnl: np.ndarray = None, max_dd: np.ndarray = None,
+                 rank: np.ndarray = None, crowding_distance: np.ndarray = None):
+        self.params_data = params_data
+        self.param_names = list(params_data.keys())
+        self.params = np.asarray(params, dtype = "float64").reshape(-1, len(self.param_names))
+        size = len(self.params)
+        self.pnl = np.zeros(size) if pnl is None else np.asarray(pnl, dtype = "float64")
+        self.max_dd = np.zeros(size) if max_dd is None else np.asarray(max_dd, dtype = "float64")
+        self.rank = np.zeros(size, dtype = np.int64) if rank is None else np.asarray(rank, dtype = np.int64)
+        self.crowding_distance = np.zeros(size) if crowding_distance is None else np.asarray(crowding_distance, dtype = "float64")
+        
+    def __len__(self):
+        return len(self.params)
+    
+    def __repr__(self):
+        return f"Population of {len(self)} individuals, Parameters = {self.param_names}"
+    
+    @classmethod
+    def from_results(cls, results: typing.List[BacktestResult], params_data: typing.Dict) -> "Population":
+        params = [[bt.parameters[p] for p in params_data] for bt in results]
+        return cls(params_data, params, [bt.pnl for bt in results], [bt.max_dd for bt in results],
+                   [bt.rank for bt in results], [bt.crowding_distance for bt in results])
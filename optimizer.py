@@ -1,31 +1,231 @@
 from utils import START_PARAMS
 import typing
-from database import Hdf5Client
-from utils import resample_timeframe
-from models import BacktestResult
-import random
-import strategies.obv, strategies.ichimoku, strategies.support_resistance
-from copy import deepcopy
+from database import MmapClient, open_bars_source
+from utils import SharedFrame, attach_shared_frame
+from models import BacktestResult, Population
+from pareto import non_dominated_ranks, fronts_from_ranks, crowding_distances, hypervolume_2d
+from registry import get_strategy, STRATEGIES
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from collections import OrderedDict
+import logging
+import os
+import pickle
+import time
+import numpy as np
+
+logger = logging.getLogger()
+
+# Layout of the files written by Nsga2.save_checkpoint
+CHECKPOINT_VERSION = 3
+# Layout of the keys stored by FitnessCache.save, the files of another layout are not loaded
+CACHE_VERSION = 3
+
+# Data of each symbol in a pool worker process, attached once from shared memory
+_worker_data = dict()
+_worker_handles = []
+
+
+def _init_worker(specs: typing.Dict[str, typing.Dict]):
+    for symbol, spec in specs.items():
+        if "mmap" in spec:
+            # Memory-mapped export: every worker maps the same files
+            _worker_data[symbol] = MmapClient(spec["mmap"]).get_resampled_data(symbol, spec["tf"], spec["from_time"], spec["to_time"])
+        else:
+            _worker_data[symbol], handles = attach_shared_frame(spec)
+            _worker_handles.extend(handles)
+        
+
+def _evaluate_worker(strategy: str, symbol: str, params: typing.List[typing.Dict], from_time: typing.Optional[int] = None,
+                     options: typing.Optional[typing.Dict] = None) -> typing.List[typing.Tuple[float, float]]:
+    return get_strategy(strategy, **(options or dict())).backtest_many(_window(_worker_data[symbol], from_time), params)
+
+
+def _window(data: pd.DataFrame, from_time: typing.Optional[int]) -> pd.DataFrame:
+    # Bars from from_time (milliseconds) to the end, all of them when from_time is None
+    if from_time is None or data is None:
+        return data
+    return data.iloc[data.index.searchsorted(pd.Timestamp(from_time, unit = "ms")):]
+
+
+def parse_fidelity(text: str) -> typing.List[typing.Tuple[float, float]]:
+    # "0.1:0.5,0.3:0.5" -> [(0.1, 0.5), (0.3, 0.5)], see Nsga2
+    return check_fidelity([step.split(":") for step in text.split(",") if step.strip() != ""])
+
+
+def check_fidelity(schedule: typing.Optional[typing.List]) -> typing.List[typing.Tuple[float, float]]:
+    # (window, keep) steps: the windows must increase between 0 and 1 and the kept parts be in ]0, 1]
+    schedule = [] if schedule is None else [(float(window), float(keep)) for window, keep in schedule]
+    for (window, keep), previous in zip(schedule, [0.0] + [window for window, _ in schedule]):
+        if not previous < window < 1 or not 0 < keep <= 1:
+            raise ValueError(f"Wrong fidelity schedule {schedule}: the windows must increase between 0 and 1 "
+                             f"and the kept parts be in ]0, 1]")
+    return schedule
+
+
+def data_fingerprint(data: typing.Optional[pd.DataFrame]) -> typing.Tuple:
+    # Number of bars, first and last bar (milliseconds) and a checksum of the values:
+    # candles inserted inside the window (backfill) change the fingerprint of its bars
+    if data is None or len(data) == 0:
+        return 0, None, None, 0
+    checksum = int(pd.util.hash_pandas_object(data, index = True).to_numpy().sum())
+    return len(data), data.index[0].value // 1_000_000, data.index[-1].value // 1_000_000, checksum
+
+
+def read_checkpoint(path: str) -> typing.Dict:
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+class FitnessCache:
+    
+    """
+    Bounded LRU cache of backtest results (pnl, max_dd) keyed by the strategy,
+    the data window and the parameters, optionally persisted with pickle
+    """
+    
+    def __init__(self, max_size: int = 100_000, path: typing.Optional[str] = None):
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._results: typing.OrderedDict[typing.Tuple, typing.Tuple[float, float]] = OrderedDict()
+        
+        if self.path is not None and os.path.exists(self.path):
+            self.load()
+    
+    @staticmethod
+    def make_key(strategy: typing.Tuple, exchange: str, symbol: str, tf: str, from_time: int, to_time: int, fingerprint: typing.Tuple,
+                 params: typing.Dict) -> typing.Tuple:
+        # strategy is Strategy.key (name, version of the code, options), to_time is the end of the stored data
+        # (not the requested one, often "now") and fingerprint identifies the bars of the window (see data_fingerprint),
+        # so a result is reused only for the same code on the same bars
+        return strategy, exchange, symbol, tf, from_time, to_time, fingerprint, tuple(sorted(params.items()))
+    
+    def get(self, key: typing.Tuple) -> typing.Union[None, typing.Tuple[float, float]]:
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # Most recently used goes to the end
+            self._results.move_to_end(key)
+        return result
+    
+    def put(self, key: typing.Tuple, result: typing.Tuple[float, float]):
+        self._results[key] = result
+        self._results.move_to_end(key)
+        # Drop the least recently used results
+        while len(self._results) > self.max_size:
+            self._results.popitem(last = False)
+            
+    def __len__(self):
+        return len(self._results)
+    
+    def __contains__(self, key: typing.Tuple) -> bool:
+        # Does not count as a hit or a miss
+        return key in self._results
+    
+    def load(self):
+        with open(self.path, "rb") as f:
+            stored = pickle.load(f)
+        if not isinstance(stored, dict) or stored.get("version") != CACHE_VERSION:
+            logger.info("%s was saved with another key layout, its results are not used", self.path)
+            return
+        for key, result in stored["results"]:
+            self.put(key, result)
+        logger.info("Loaded %s cached backtest results from %s", len(self._results), self.path)
+    
+    def save(self):
+        if self.path is None:
+            return
+        # Write to a temporary file first so an interrupted save does not corrupt the cache
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": CACHE_VERSION, "results": list(self._results.items())}, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total > 0 else 0.0
+        return f"Fitness cache: {self.hits} hits, {self.misses} misses ({round(hit_rate, 2)} % hit rate), {len(self._results)} stored"
+
 
 class Nsga2:
     
-    def __init__(self, exchange: str, symbol: str, strategy: str, tf: str, from_time: int, to_time: int,
-                 population_size: int):
+    def __init__(self, exchange: str, symbol: typing.Union[str, typing.List[str]], strategy: str, tf: str, from_time: int,
+                 to_time: int, population_size: int, workers: int = 1, cache_size: int = 100_000,
+                 cache_path: typing.Optional[str] = None, seed: typing.Optional[int] = None,
+                 data: typing.Union[None, pd.DataFrame, typing.Dict[str, pd.DataFrame]] = None,
+                 fidelity: typing.Optional[typing.List[typing.Tuple[float, float]]] = None,
+                 options: typing.Optional[typing.Dict] = None):
         # Define
         self.exchange = exchange
-        self.symbol = symbol
+        # A list of symbols is a basket: each individual is backtested on every symbol,
+        # its pnl is the mean pnl and its max_dd the worst drawdown
+        self.symbols = [symbol] if isinstance(symbol, str) else list(symbol)
         self.strategy = strategy
+        # Options of the strategy (fee / slippage of sup_res), checked by get_strategy
+        self.options = dict() if options is None else dict(options)
+        self.strategy_key = get_strategy(strategy, **self.options).key()
         self.tf = tf
         self.from_time = from_time
         self.to_time = to_time
         self.population_size = population_size
         self.params_data = START_PARAMS[self.strategy]
         self.population_params = []
+        # Number of processes used to evaluate a population (1 = serial)
+        self.workers = workers
+        self._pool = None
+        self._shared_data = []
+        self._mmap = dict()
+        # Results of parameters already backtested on this window
+        self.cache = FitnessCache(cache_size, cache_path)
+        # Random generator of the selection, crossover and mutation (fixed seed = reproducible run)
+        self.rng = np.random.default_rng(seed)
+        # Metrics of each generation, the first Pareto front of each generation
+        # and the hypervolume reference point (fixed by the initial population)
+        self.metrics = []
+        self._front_history = []
+        self._reference = None
+        # Multi-fidelity evaluation of the offspring (successive halving), one (window, keep) step per screening:
+        # the candidates are backtested on the last window part of the bars and the best keep part of them
+        # goes to the next step, the ones left after the last step are backtested on the whole window
+        self.fidelity = check_fidelity(fidelity)
+        # Bars backtested since the start, all the symbols together
+        self.bars = 0
+        # End and fingerprint of the data of each window used in the cache keys, by first timestamp
+        self._window_keys = dict()
+        
+        self.datasets = dict()
+        if data is not None:
+            # Bars already loaded by the caller (batch jobs), by symbol for a basket
+            self.datasets = data if isinstance(data, dict) else {self.symbols[0]: data}
+        elif self.strategy in STRATEGIES:
+            # Every series is read and resampled once for the whole optimization
+            for s in self.symbols:
+                db = open_bars_source(exchange, s, tf)
+                self.datasets[s] = db.get_resampled_data(s, self.tf, self.from_time, self.to_time)
+                self._mmap[s] = isinstance(db, MmapClient)
+        
+        if len(self.symbols) > 1:
+            missing = [s for s in self.symbols if self.datasets.get(s) is None or len(self.datasets[s]) == 0]
+            if len(missing) > 0:
+                logger.warning("No %s data for %s, removed from the basket", self.tf, missing)
+                self.symbols = [s for s in self.symbols if s not in missing]
+                if len(self.symbols) == 0:
+                    raise ValueError("No data for any symbol of the basket")
         
-        if self.strategy in ["obv", "ichimoku", "sup_res"]:
-            h5_db = Hdf5Client(exchange)
-            self.data = h5_db.get_data(self.symbol, self.from_time, self.to_time)
-            self.data = resample_timeframe(self.data, self.tf)
+        self.symbol = ",".join(self.symbols)
+        self.data = self.datasets.get(self.symbols[0]) if len(self.symbols) > 0 else None
+        
+        # First timestamp (milliseconds) of the window of each fidelity step
+        self._fidelity_starts = []
+        if len(self.fidelity) > 0 and all(len(self.datasets.get(s, [])) > 0 for s in self.symbols):
+            first = min(self.datasets[s].index[0].value for s in self.symbols) // 1_000_000
+            last = max(self.datasets[s].index[-1].value for s in self.symbols) // 1_000_000
+            self._fidelity_starts = [int(last - window * (last - first)) for window, _ in self.fidelity]
             
             
     def create_initial_population(self) -> typing.List[BacktestResult]:
@@ -35,18 +235,12 @@ class Nsga2:
         """
         # Population
         population = []
+        seen = self._seen_params()
         
+        # Individuals are drawn in batches, repeated parameters are dropped
         while len(population) < self.population_size:
-            backtest = BacktestResult()
-            for key, value in self.params_data.items():
-                if value["type"] == int:
-                    backtest.parameters[key] = random.randint(value["min"], value["max"])
-                elif value["type"] == float:
-                    backtest.parameters[key] = round(random.uniform(value["min"], value["max"]), value["decimals"])
-                
-            if backtest not in population:
-                population.append(backtest)
-                self.population_params.append(backtest.parameters)
+            candidates = self._random_params(self.population_size - len(population))
+            self._add_unique(candidates, population, seen, constraints = False)
             
         return population
     
@@ -54,99 +248,141 @@ class Nsga2:
     def crowding_distance(self, evaluated_population: typing.List[BacktestResult]) -> typing.List[BacktestResult]:
         # Get Crowding Distance for each individual once thier pnl and max_dd were calculated
         # A grater crowding distance means better.
-        for objective  in ["pnl", "max_dd"]:
-            # Sort Evaluated Population
-            population = sorted(evaluated_population, key = lambda x: getattr(x, objective))
-            # Get min and max value
-            min_value = getattr(min(population, key = lambda x: getattr(x, objective)), objective)
-            max_value = getattr(max(population, key = lambda x: getattr(x, objective)), objective)
-            # Exclude First and last one since they have the highest and lowest value
-            # More than two values can be inf since a for is being used
-            population[0].crowding_distance = float("inf")
-            population[-1].crowding_distance = float("inf")
-            for i in range(1, len(population) - 1):
-                distance = getattr(population[i + 1], objective) - getattr(population[i - 1], objective)
-                # Avoiding Division by 0
-                if max_value - min_value != 0:
-                    # Best individuals will have a bigger crowding distance since denominator will be smaller
-                    distance = distance / (max_value - min_value)
-                    population[i].crowding_distance += distance
-                
-        return population
+        values = np.array([[bt.pnl, bt.max_dd] for bt in evaluated_population], dtype = "float64").reshape(-1, 2)
+        distances = crowding_distances(values)
+        
+        for bt, distance in zip(evaluated_population, distances):
+            bt.crowding_distance = float(distance)
+        
+        # Sorted by the last objective as before
+        order = np.argsort(values[:, 1], kind = "stable")
+        
+        return [evaluated_population[i] for i in order]
             
    
     def create_new_population(self, fronts: typing.List[typing.List[BacktestResult]]) -> typing.List[typing.List[BacktestResult]]:
         # Create next generation of population
-        new_pop = []
-        # The code will choose the individuals with best performance
-        for front in fronts:
-            # Loop front by front untill we create a new population with the best individuals,
-            # so if in F1 (front with best performance has 5 individuals 15 will be left)
-            # so the code will continue to F2 to find the next n best individuals untill 
-            # a new population is formed
-            if len(new_pop) + len(front) > self.population_size:
-                max_individuals = self.population_size - len(new_pop)
-                if max_individuals > 0:
-                    new_pop += sorted(front, key = lambda x: getattr(x, "crowding_distance"))[-max_individuals:]
-            else:
-                new_pop += front
+        individuals = [bt for front in fronts for bt in front]
+        rank = np.repeat(np.arange(len(fronts)), [len(front) for front in fronts])
+        crowding = np.array([bt.crowding_distance for bt in individuals], dtype = "float64")
+        
+        selected = np.sort(self._survivors(rank, crowding))
    
-        return new_pop
+        return [individuals[i] for i in selected]
+    
+    
+    def _survivors(self, rank: np.ndarray, crowding: np.ndarray) -> np.ndarray:
+        # The code will choose the individuals with best performance: whole fronts are kept
+        # while they fit, and the last front is completed with its least crowded individuals
+        # (the later individual wins a tie, as with the previous stable sort)
+        order = np.lexsort((-np.arange(len(rank)), -crowding, rank))
+        
+        return order[:self.population_size]
     
     
     def create_offspring_population(self, population: typing.List[BacktestResult]) -> typing.List[BacktestResult]:
         
+        parents = Population.from_results(population, self.params_data)
+        
         offspring_pop = []
+        seen = self._seen_params()
         
         # Offspring Population length must be equal to population_size
         while len(offspring_pop) != self.population_size:
-            parents: typing.List[BacktestResult] = []
-            # Select 2 parents to create one new child with the best of the two parents
-            for i in range(2):
-                random_parents = random.sample(population, k = 2)
-                # Check who's the best parent
-                if random_parents[0].rank != random_parents[1].rank:
-                    best_parent = min(random_parents, key = lambda x: getattr(x, "rank"))
-                else:
-                    best_parent = max(random_parents, key = lambda x: getattr(x, "crowding_distance"))
-                # Append the parent with the best qualities
-                parents.append(best_parent)
-            new_child = BacktestResult()
-            new_child.parameters = deepcopy(parents[0].parameters)
-            
-            # Croosover 
-            number_of_crossovers = random.randint(1, len(self.params_data))
-            # Choose sample among params from each indicator
-            params_to_cross = random.sample(list(self.params_data.keys()), k = number_of_crossovers)
-            
-            # (It can change from 1 to all params from first parent)
-            for p in params_to_cross:
-                new_child.parameters[p] = deepcopy(parents[1].parameters[p])
-        
-            # Mutation
-            number_of_mutations = random.randint(0, len(self.params_data))
-            params_to_change = random.sample(list(self.params_data.keys()), k = number_of_mutations)
-            
-            for p in params_to_change:
-                mutation_strength = random.uniform(-2, 2)
-                new_child.parameters[p] = self.params_data[p]["type"](new_child.parameters[p] * (1 + mutation_strength))
-                # Check boundaries
-                new_child.parameters[p] = max(new_child.parameters[p], self.params_data[p]["min"])
-                new_child.parameters[p] = min(new_child.parameters[p], self.params_data[p]["max"])
+            candidates = self.offspring_params(parents, self.population_size - len(offspring_pop))
+            # Check if and individual of the new population is not repeated
+            self._add_unique(candidates, offspring_pop, seen)
+                
+        return offspring_pop 
+    
+    
+    def offspring_params(self, population: Population, size: int) -> np.ndarray:
+        # Select 2 parents to create one new child with the best of the two parents
+        first_parents = self._tournament(population, size)
+        second_parents = self._tournament(population, size)
+        
+        # Croosover (It can change from 1 to all params from first parent)
+        from_second = self._random_params_mask(size, min_count = 1)
+        children = np.where(from_second, population.params[second_parents], population.params[first_parents])
+        
+        # Mutation (from 0 to all params)
+        mutate = self._random_params_mask(size, min_count = 0)
+        mutated = children * (1 + self.rng.uniform(-2, 2, children.shape))
+        
+        for j, value in enumerate(self.params_data.values()):
+            if value["type"] == int:
+                mutated[:, j] = np.trunc(mutated[:, j])
+            # Check boundaries
+            mutated[:, j] = np.clip(mutated[:, j], value["min"], value["max"])
+            # Round
+            if value["type"] == float:
+                mutated[:, j] = np.round(mutated[:, j], value["decimals"])
                 
-                # Round
-                if self.params_data[p]["type"] == float:
-                    new_child.parameters[p] = round(new_child.parameters[p], self.params_data[p]["decimals"])
+        return np.where(mutate, mutated, children)
+    
+    
+    def _tournament(self, population: Population, size: int) -> np.ndarray:
+        # Two different random individuals per tournament
+        first = self.rng.integers(0, len(population), size)
+        second = self.rng.integers(0, len(population) - 1, size)
+        second += second >= first
+        
+        # Check who's the best parent: lower rank, or bigger crowding distance in the same front
+        first_wins = np.where(population.rank[first] != population.rank[second],
+                              population.rank[first] < population.rank[second],
+                              population.crowding_distance[first] >= population.crowding_distance[second])
+        
+        return np.where(first_wins, first, second)
+    
+    
+    def _random_params_mask(self, size: int, min_count: int) -> np.ndarray:
+        # For each row choose between min_count and all the params, in a random order
+        nb_params = len(self.params_data)
+        counts = self.rng.integers(min_count, nb_params + 1, size)
+        order = np.argsort(self.rng.random((size, nb_params)), axis = 1)
+        
+        mask = np.zeros((size, nb_params), dtype = bool)
+        np.put_along_axis(mask, order, np.arange(nb_params)[None, :] < counts[:, None], axis = 1)
+        
+        return mask
+    
+    
+    def _random_params(self, size: int) -> np.ndarray:
+        params = np.empty((size, len(self.params_data)))
+        
+        for j, value in enumerate(self.params_data.values()):
+            if value["type"] == int:
+                params[:, j] = self.rng.integers(value["min"], value["max"] + 1, size)
+            elif value["type"] == float:
+                params[:, j] = np.round(self.rng.uniform(value["min"], value["max"], size), value["decimals"])
+                
+        return params
+    
+    
+    def _seen_params(self) -> typing.Set[typing.Tuple]:
+        return {tuple(sorted(p.items())) for p in self.population_params}
+    
+    
+    def _add_unique(self, candidates: np.ndarray, population: typing.List[BacktestResult], seen: typing.Set[typing.Tuple],
+                    constraints: bool = True):
+        # Append the candidates whose parameters are new until the population is full
+        names = list(self.params_data.keys())
+        for row in candidates:
+            if len(population) == self.population_size:
+                break
             
+            params = {p: self.params_data[p]["type"](v) for p, v in zip(names, row)}
             # Check params must be according the strategy
-            new_child.parameters = self._params_constraints(new_child.parameters)
-            
-            # Check if and individual of the new population is not repeated
-            if new_child.parameters not in self.population_params:
-                offspring_pop.append(new_child)
-                self.population_params.append(new_child.parameters)
+            if constraints:
+                params = self._params_constraints(params)
                 
-        return offspring_pop 
+            key = tuple(sorted(params.items()))
+            if key not in seen:
+                seen.add(key)
+                backtest = BacktestResult()
+                backtest.parameters = params
+                population.append(backtest)
+                self.population_params.append(params)
     
     
     def _params_constraints(self, params: typing.Dict) -> typing.Dict:
@@ -161,82 +397,334 @@ class Nsga2:
     
     
     def non_dominated_sorting(self, population: typing.Dict[int, BacktestResult]) -> typing.List[typing.List[BacktestResult]]:
+        # Find the pareto frontier (non-dominated individuals) and the next fronts.
+        # pnl is maximized and max_dd minimized, so pnl is negated to minimize both
+        individuals = list(population.values())
+        objectives = np.array([[-bt.pnl, bt.max_dd] for bt in individuals], dtype = "float64").reshape(-1, 2)
+        
+        ranks = non_dominated_ranks(objectives)
+        
         fronts = []
-        # Compare all against all to find the pareto frontier (non-dominated individuals)
-        for id_1, indiv_1 in population.items():
-            for id_2, indiv_2 in population.items():
-                # Check if indiv_1 dominates others individuals
-                if indiv_1.pnl >= indiv_2.pnl and indiv_1.max_dd <= indiv_2.max_dd \
-                    and (indiv_1.pnl > indiv_2.pnl or indiv_1.max_dd < indiv_2.max_dd):
-                    # Add to indiv_1 dominates own list
-                    indiv_1.dominates.append(id_2) # id_2 is a number [0, 1, 2, ..., len(random_samples_created)]
-                elif indiv_2.pnl >= indiv_1.pnl and indiv_2.max_dd <= indiv_1.max_dd \
-                    and (indiv_2.pnl > indiv_1.pnl or indiv_2.max_dd < indiv_1.max_dd):    
-                    # Add to indiv_2 dominates own list
-                    indiv_1.dominated_by += 1
-            if indiv_1.dominated_by == 0:
-                if len(fronts) == 0:
-                    fronts.append([])
-                fronts[0].append(indiv_1)
-                # It will affect the value added to fronts since they're the same
-                indiv_1.rank = 0
-                
-        # Find the next most dominating individuals    
-        i = 0
-        while True:
+        for rank, front in enumerate(fronts_from_ranks(ranks)):
             fronts.append([])
-            for indiv_1 in fronts[i]:
-                # Decrease one to find the new non-dominated individual
-                for indiv_2_id in indiv_1.dominates:
-                    population[indiv_2_id].dominated_by -= 1
-                    if population[indiv_2_id].dominated_by == 0:
-                        # Check to not duplicate
-                        if population[indiv_2_id] not in fronts[i + 1]:
-                            fronts[i + 1].append(population[indiv_2_id])
-                            # It will affect the value added to fronts since they're the same
-                            population[indiv_2_id].rank = i + 1
-            # Check if a new non-dominated individual was found
-            if len(fronts[i + 1]) > 0:
-                i += 1
-            # Non-dominated individual was found
-            else:
-                del fronts[-1]
-                break
+            for idx in front:
+                individuals[idx].rank = rank
+                fronts[rank].append(individuals[idx])
             
         return fronts
             
             
-    def evaluate_population(self, population_individuals: typing.List[BacktestResult]) -> typing.List[BacktestResult]:
-        if self.strategy == "obv":
-            for bt in population_individuals:
-                bt.pnl, bt.max_dd= strategies.obv.backtest(self.data, ma_period = bt.parameters["ma_period"])
-                # If no profit, insert -inf so it does not keep in the algorithm when optimizing
-                if bt.pnl == 0:
-                        bt.pnl = -float("inf")
-                        bt.max_dd = float("inf")
-                        
-            return population_individuals
+    def evaluate_population(self, population_individuals: typing.List[BacktestResult],
+                            fidelity: bool = False) -> typing.List[BacktestResult]:
+        # With fidelity the individuals are screened on shorter windows first (see self.fidelity),
+        # the ones dropped by the screening get the worst results
+        individuals = population_individuals
+        if fidelity and len(self._fidelity_starts) > 0:
+            # Parameters already backtested on the whole window skip the screening
+            dropped = {id(bt) for bt in self._screen([bt for bt in population_individuals
+                                                       if self._cache_key(bt.parameters) not in self.cache])}
+            individuals = [bt for bt in population_individuals if id(bt) not in dropped]
+        
+        for bt, result in zip(individuals, self._evaluate_window([bt.parameters for bt in individuals])):
+            bt.pnl, bt.max_dd = result
+        
+        for bt in population_individuals:
+            # If no profit, insert -inf so it does not keep in the algorithm when optimizing
+            if bt.pnl == 0:
+                bt.pnl = -float("inf")
+                bt.max_dd = float("inf")
+                
+        return population_individuals
+    
+    
+    def _screen(self, candidates: typing.List[BacktestResult]) -> typing.List[BacktestResult]:
+        # Successive halving, returns the candidates dropped by one of the fidelity steps.
+        # They are ranked like a population (fronts then crowding distance) on the results of the shorter window
+        dropped = []
+        for start, (_, keep) in zip(self._fidelity_starts, self.fidelity):
+            if len(candidates) == 0:
+                break
             
-        elif self.strategy == "ichimoku":
-            self.data.columns = ["Open", "High", "Low", "Close", "Volume"]
-            for bt in population_individuals:
-                bt.pnl, bt.max_dd = strategies.ichimoku.backtest(self.data, tenkan_period = bt.parameters["kijun"], kijun_period = bt.parameters["tenkan"])
-                # If no profit, insert -inf so it does not keep in the algorithm when optimizing
-                if bt.pnl == 0:
-                    bt.pnl = -float("inf")
-                    bt.max_dd = float("inf")
-                    
-            self.data.columns = ["open", "high", "low", "close", "volume"]
-            
-            return population_individuals
+            results = np.array(self._evaluate_window([bt.parameters for bt in candidates], start), dtype = "float64").reshape(-1, 2)
+            # No trade or no result is the worst
+            objectives = np.column_stack([-results[:, 0], results[:, 1]])
+            objectives[~np.isfinite(objectives).all(axis = 1) | (results[:, 0] == 0)] = np.inf
             
-        elif self.strategy == "sup_res":
-            for bt in population_individuals:
-                bt.pnl, bt.max_dd = strategies.support_resistance.backtest(self.data, min_points = bt.parameters["min_points"], min_diff_points = bt.parameters["min_diff_points"],
-                                                             rounding_nb = bt.parameters["rounding_nb"], take_profit = bt.parameters["take_profit"], stop_loss = bt.parameters["stop_loss"]) 
-                # If no profit, insert -inf so it does not keep in the algorithm when optimizing
-                if bt.pnl == 0:
-                    bt.pnl = -float("inf")
-                    bt.max_dd = float("inf")
-                    
-            return population_individuals
\ No newline at end of file
+            rank = non_dominated_ranks(objectives)
+            crowding = crowding_distances(np.where(np.isfinite(objectives), objectives, 0.0), rank)
+            kept = np.sort(np.lexsort((-crowding, rank))[:int(np.ceil(keep * len(candidates)))])
+            
+            for i in np.setdiff1d(np.arange(len(candidates)), kept):
+                candidates[i].pnl = -float("inf")
+                candidates[i].max_dd = float("inf")
+                dropped.append(candidates[i])
+            candidates = [candidates[i] for i in kept]
+            
+        return dropped
+    
+    
+    def _evaluate_window(self, params: typing.List[typing.Dict],
+                         from_time: typing.Optional[int] = None) -> typing.List[typing.Tuple[float, float]]:
+        # Results on the bars from from_time (the whole window when None),
+        # only the parameters never evaluated before on this window are backtested
+        keys = [self._cache_key(p, from_time) for p in params]
+        results = [self.cache.get(key) for key in keys]
+        pending = [i for i, result in enumerate(results) if result is None]
+        
+        for i, result in zip(pending, self._backtest_params([params[i] for i in pending], from_time)):
+            results[i] = result
+            self.cache.put(keys[i], result)
+            
+        return results
+    
+    
+    def _cache_key(self, params: typing.Dict, from_time: typing.Optional[int] = None) -> typing.Tuple:
+        if from_time not in self._window_keys:
+            windows = [_window(self.datasets.get(s), from_time) for s in self.symbols]
+            fingerprint = tuple(data_fingerprint(data) for data in windows)
+            # The window ends at the last stored bar when to_time is later
+            last = max([f[2] for f in fingerprint if f[2] is not None], default = self.to_time)
+            self._window_keys[from_time] = (min(self.to_time, last), fingerprint)
+        
+        to_time, fingerprint = self._window_keys[from_time]
+        return FitnessCache.make_key(self.strategy_key, self.exchange, self.symbol, self.tf,
+                                     self.from_time if from_time is None else from_time, to_time, fingerprint, params)
+    
+    
+    def _backtest_params(self, params: typing.List[typing.Dict],
+                         from_time: typing.Optional[int] = None) -> typing.List[typing.Tuple[float, float]]:
+        # The individuals are backtested in batches (one per symbol, or per symbol and worker task)
+        # so the strategies share their indicators between them
+        self.bars += len(params) * sum(len(_window(self.datasets[s], from_time)) for s in self.symbols)
+        
+        if self.workers > 1 and len(params) > 1:
+            self._start_pool()
+            size = max(1, len(params) // (self.workers * 4))
+            chunks = [params[i:i + size] for i in range(0, len(params), size)]
+            symbols = [s for s in self.symbols for _ in chunks]
+            batches = list(self._pool.map(_evaluate_worker, repeat(self.strategy), symbols, chunks * len(self.symbols),
+                                          repeat(from_time), repeat(self.options)))
+            # map keeps the order of the tasks: every chunk of the first symbol, then of the next one
+            results = [[r for batch in batches[i * len(chunks):(i + 1) * len(chunks)] for r in batch] for i in range(len(self.symbols))]
+        else:
+            results = [get_strategy(self.strategy, **self.options).backtest_many(_window(self.datasets[s], from_time), params) for s in self.symbols]
+        
+        if len(self.symbols) == 1:
+            return results[0]
+        
+        # Basket objectives: mean pnl and worst drawdown of each individual (a symbol without trades has no drawdown)
+        results = np.array(results, dtype = "float64").transpose(1, 0, 2)
+        
+        return [(float(pnl), float(max_dd)) for pnl, max_dd in zip(results[:, :, 0].mean(axis = 1), np.fmax.reduce(results[:, :, 1], axis = 1))]
+    
+    
+    def _start_pool(self):
+        # The workers map the exported files, or the resampled data is copied to shared memory
+        # once for the whole optimization
+        if self._pool is None:
+            specs = dict()
+            for s in self.symbols:
+                if self._mmap.get(s, False):
+                    specs[s] = {"mmap": self.exchange, "tf": self.tf, "from_time": self.from_time, "to_time": self.to_time}
+                else:
+                    self._shared_data.append(SharedFrame(self.datasets[s]))
+                    specs[s] = self._shared_data[-1].spec
+            self._pool = ProcessPoolExecutor(max_workers = self.workers, initializer = _init_worker,
+                                             initargs = (specs,))
+            
+            
+    def optimize(self, generations: int, checkpoint_path: typing.Optional[str] = None, checkpoint_every: int = 1,
+                 patience: typing.Optional[int] = None, min_improvement: float = 1e-3) -> typing.List[BacktestResult]:
+        # Whole NSGA-II run, returns the last population.
+        # With a checkpoint path the state is saved every checkpoint_every generations,
+        # and the run continues from the checkpoint if the file exists.
+        # With patience the run stops early once the hypervolume of the first front improved by less than
+        # min_improvement (relative) or the front did not change during the last patience generations
+        # The fidelity schedule only applies to the offspring: the initial population is backtested on the whole window,
+        # so a run with the same seed has the same hypervolume reference point and both fronts can be compared
+        start_generation = time.time()
+        misses = self.cache.misses
+        bars = self.bars
+        
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            if self.cache.path is None and os.path.exists(checkpoint_path + ".cache"):
+                self.cache.path = checkpoint_path + ".cache"
+                self.cache.load()
+            p_population, g = self.restore_checkpoint(read_checkpoint(checkpoint_path))
+            logger.info("%s %s %s: resuming from generation %s of %s", self.strategy, self.symbol, self.tf, g, checkpoint_path)
+        else:
+            # Create Population
+            initial_population = self.create_initial_population()
+            
+            # Evaluate
+            evaluated_population = self.evaluate_population(initial_population)
+            
+            # Add crowding distance to see which are better
+            # This crowding distance will be used to create a new sample with the 
+            # best of two parents chosen randomly
+            p_population = self.crowding_distance(evaluated_population)
+            
+            g = 0
+            self._record_metrics(p_population, g, self.cache.misses - misses, self.bars - bars, time.time() - start_generation)
+            if checkpoint_path is not None:
+                self.save_checkpoint(checkpoint_path, p_population, g)
+        
+        while g < generations:
+            if patience is not None and self._converged(patience, min_improvement):
+                logger.info("%s %s %s: converged, stopped after generation %s / %s", self.strategy, self.symbol, self.tf,
+                            g, generations)
+                if checkpoint_path is not None:
+                    self.save_checkpoint(checkpoint_path, p_population, g)
+                break
+            
+            start_generation = time.time()
+            misses = self.cache.misses
+            bars = self.bars
+            
+            # Create an ofspring populatin. It is supposed to be better from 
+            # intial population, since it is taking the best from 2 parents
+            # chosen randomly.
+            
+            # Add offspring population (A "better" one)
+            q_population = self.create_offspring_population(p_population)
+            
+            # Evaluate new offspring population (screened on shorter windows with a fidelity schedule)
+            q_population = self.evaluate_population(q_population, fidelity = True)
+            
+            # Add populations
+            r_population = p_population + q_population
+            
+            # Remove previous params from strategies for new generation
+            self.population_params.clear()
+            
+            # Reset all params except pnl and max_dd
+            # They will be reset because sample is now bigger and they must be
+            # computed again
+            i = 0
+            population = dict()
+            for bt in r_population:
+                bt.reset_results()
+                self.population_params.append(bt.parameters)
+                population[i] = bt
+                i += 1
+            
+            # Find non-dominated individuals (F1, F2, F3) according to its levels
+            # F1 Frontier dominates F2 Frontier, F2 Frontier dominates F3 Frontier, ... until non-dominated individuals are found
+            fronts = self.non_dominated_sorting(population)
+            
+            # Get crowding distance of old population and the new "better" one
+            # but by fronts
+            for j in range(len(fronts)):
+                fronts[j] = self.crowding_distance(fronts[j])
+            
+            p_population = self.create_new_population(fronts)
+            
+            g += 1
+            
+            self._record_metrics(p_population, g, self.cache.misses - misses, self.bars - bars, time.time() - start_generation)
+            
+            if checkpoint_path is not None and (g % checkpoint_every == 0 or g == generations):
+                self.save_checkpoint(checkpoint_path, p_population, g)
+            
+        return p_population
+    
+    
+    def _record_metrics(self, population: typing.List[BacktestResult], generation: int, backtests: int, bars: int,
+                        seconds: float):
+        objectives = np.array([[-bt.pnl, bt.max_dd] for bt in population], dtype = "float64").reshape(-1, 2)
+        finite = np.isfinite(objectives).all(axis = 1)
+        
+        # The reference point is the worst individual of the first population plus 10 % of the range,
+        # it stays the same afterwards so the hypervolumes can be compared
+        if self._reference is None and finite.any():
+            worst = objectives[finite].max(axis = 0)
+            span = worst - objectives[finite].min(axis = 0)
+            self._reference = worst + np.where(span > 0, span * 0.1, 1.0)
+        
+        ranks = non_dominated_ranks(np.where(np.isfinite(objectives), objectives, np.inf))
+        front = np.flatnonzero((ranks == 0) & finite)
+        self._front_history.append(frozenset(tuple(sorted(population[i].parameters.items())) for i in front))
+        
+        metrics = {"generation": generation,
+                   "hypervolume": hypervolume_2d(objectives, self._reference) if self._reference is not None else 0.0,
+                   "front_size": len(front),
+                   "best_pnl": float(-objectives[finite, 0].min()) if finite.any() else float("nan"),
+                   "best_max_dd": float(objectives[finite, 1].min()) if finite.any() else float("nan"),
+                   "backtests": backtests, "bars": bars, "seconds": seconds}
+        self.metrics.append(metrics)
+        
+        logger.info("%s %s %s: generation %s, hypervolume %s, %s individuals on the front, best pnl %s, best max dd %s, "
+                    "%s backtests (%s bars) in %s seconds", self.strategy, self.symbol, self.tf, generation,
+                    round(metrics["hypervolume"], 6), metrics["front_size"], round(metrics["best_pnl"], 4),
+                    round(metrics["best_max_dd"], 4), backtests, bars, round(seconds, 2))
+    
+    
+    def _converged(self, patience: int, min_improvement: float) -> bool:
+        # Compare the last generation to the one patience generations before
+        if len(self.metrics) <= patience:
+            return False
+        
+        before = self.metrics[-patience - 1]["hypervolume"]
+        improvement = self.metrics[-1]["hypervolume"] - before
+        if before > 0 and improvement <= min_improvement * before:
+            return True
+        
+        # Same first front during the whole period
+        return len(self._front_history[-1]) > 0 and all(front == self._front_history[-1] for front in self._front_history[-patience - 1:])
+    
+    
+    def _checkpoint_run(self) -> typing.Dict:
+        # A checkpoint can only be resumed by the same optimization
+        return {"exchange": self.exchange, "symbol": self.symbol, "strategy": self.strategy, "tf": self.tf,
+                "from_time": self.from_time, "to_time": self.to_time, "population_size": self.population_size,
+                "options": self.options}
+    
+    
+    def save_checkpoint(self, path: str, population: typing.List[BacktestResult], generation: int):
+        # The evaluated backtests are stored in the fitness cache, next to the checkpoint if it has no file
+        if self.cache.path is None:
+            self.cache.path = path + ".cache"
+        self.cache.save()
+        
+        checkpoint = {"version": CHECKPOINT_VERSION, "run": self._checkpoint_run(), "generation": generation,
+                      "population": [{"parameters": bt.parameters, "pnl": bt.pnl, "max_dd": bt.max_dd, "rank": bt.rank,
+                                      "crowding_distance": bt.crowding_distance} for bt in population],
+                      "population_params": self.population_params, "rng_state": self.rng.bit_generator.state,
+                      "metrics": self.metrics, "front_history": self._front_history, "reference": self._reference}
+        
+        # Write to a temporary file first so a crash while saving keeps the previous checkpoint
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(checkpoint, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    
+    def restore_checkpoint(self, checkpoint: typing.Dict) -> typing.Tuple[typing.List[BacktestResult], int]:
+        # Population and generation of the checkpoint, the random generator continues where it stopped
+        if checkpoint["version"] != CHECKPOINT_VERSION or checkpoint["run"] != self._checkpoint_run():
+            raise ValueError(f"The checkpoint was saved by another optimization: {checkpoint['run']}")
+        
+        population = []
+        for individual in checkpoint["population"]:
+            bt = BacktestResult()
+            for key, value in individual.items():
+                setattr(bt, key, value)
+            population.append(bt)
+        
+        self.population_params = checkpoint["population_params"]
+        self.rng.bit_generator.state = checkpoint["rng_state"]
+        self.metrics = checkpoint["metrics"]
+        self._front_history = checkpoint["front_history"]
+        self._reference = checkpoint["reference"]
+        
+        return population, checkpoint["generation"]
+    
+    
+    def close(self):
+        # Stop the workers and release the shared memory
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        for frame in self._shared_data:
+            frame.close()
+        self._shared_data = []
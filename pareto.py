@@ -0,0 +1,151 @@
+import typing
+import numpy as np
+
+# Objective matrices have one row per individual and one column per objective.
+# Every objective is minimized, so maximized values (pnl) must be negated first.
+
+
+def non_dominated_ranks(objectives: np.ndarray) -> np.ndarray:
+    """
+    Rank of the Pareto front of each individual (0 = non-dominated)
+    """
+    objectives = np.asarray(objectives, dtype = "float64")
+
+    if len(objectives) == 0:
+        return np.zeros(0, dtype = np.int64)
+
+    if objectives.shape[1] == 2:
+        return _sweep_line_ranks(objectives)
+
+    return _fast_non_dominated_ranks(objectives)
+
+
+def fronts_from_ranks(ranks: np.ndarray) -> typing.List[np.ndarray]:
+    # Indexes of each front, keeping the original order inside the front
+    if len(ranks) == 0:
+        return []
+
+    order = np.argsort(ranks, kind = "stable")
+    bounds = np.searchsorted(ranks[order], np.arange(ranks.max() + 2))
+
+    return [order[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+def crowding_distances(values: np.ndarray, ranks: typing.Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Crowding distance of each individual inside its front (all fronts at once)
+    """
+    values = np.asarray(values, dtype = "float64")
+    size = len(values)
+    if ranks is None:
+        ranks = np.zeros(size, dtype = np.int64)
+
+    distances = np.zeros(size)
+    if size == 0:
+        return distances
+
+    for m in range(values.shape[1]):
+        # Sort by front and by the objective inside each front (stable, so ties keep their order)
+        order = np.lexsort((values[:, m], ranks))
+        column = values[order, m]
+        sorted_ranks = ranks[order]
+
+        new_front = sorted_ranks[1:] != sorted_ranks[:-1]
+        first = np.concatenate([[True], new_front])
+        last = np.concatenate([new_front, [True]])
+
+        # Range of the objective inside the front of each individual
+        starts = np.flatnonzero(first)
+        ends = np.flatnonzero(last)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            span = np.repeat(column[ends] - column[starts], ends - starts + 1)
+            neighbours = np.zeros(size)
+            neighbours[1:-1] = column[2:] - column[:-2]
+            interior = ~(first | last) & (span != 0)
+            distances[order[interior]] += neighbours[interior] / span[interior]
+
+        # First and last of each front are always kept
+        distances[order[first | last]] = float("inf")
+
+    return distances
+
+
+def hypervolume_2d(objectives: np.ndarray, reference: np.ndarray) -> float:
+    """
+    Area dominated by the individuals and bounded by the reference point (two objectives)
+    """
+    objectives = np.asarray(objectives, dtype = "float64").reshape(-1, 2)
+    # Individuals without finite objectives or beyond the reference point add nothing
+    inside = np.isfinite(objectives).all(axis = 1) & (objectives < reference).all(axis = 1)
+    objectives = objectives[inside]
+
+    if len(objectives) == 0:
+        return 0.0
+
+    # Sorted by the first objective, the non-dominated ones have a decreasing second objective
+    objectives = objectives[np.lexsort((objectives[:, 1], objectives[:, 0]))]
+    best_before = np.minimum.accumulate(np.concatenate([[np.inf], objectives[:-1, 1]]))
+    front = objectives[objectives[:, 1] < best_before]
+
+    widths = np.append(front[1:, 0], reference[0]) - front[:, 0]
+
+    return float(np.sum(widths * (reference[1] - front[:, 1])))
+
+
+def _sweep_line_ranks(objectives: np.ndarray) -> np.ndarray:
+    # O(N log N) for two objectives. Once sorted by the first objective (and the second one for ties)
+    # an individual can only be dominated by the ones before it, and inside a front the last individual
+    # added has the lowest second objective, so it is the only one that has to be compared.
+    first = objectives[:, 0]
+    second = objectives[:, 1]
+    order = np.lexsort((second, first))
+
+    ranks = np.empty(len(objectives), dtype = np.int64)
+    # Last individual added to each front
+    front_last = []
+
+    for idx in order:
+        # Being dominated by front k implies being dominated by every front before k,
+        # so the first front that does not dominate the individual is found with a binary search
+        low, high = 0, len(front_last)
+        while low < high:
+            middle = (low + high) // 2
+            last = front_last[middle]
+            if second[last] < second[idx] or (second[last] == second[idx] and first[last] != first[idx]):
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == len(front_last):
+            front_last.append(idx)
+        else:
+            front_last[low] = idx
+        ranks[idx] = low
+
+    return ranks
+
+
+def _fast_non_dominated_ranks(objectives: np.ndarray) -> np.ndarray:
+    # O(MN²) for any number of objectives: dominates[i, j] is True if i dominates j
+    all_less_equal = np.ones((len(objectives), len(objectives)), dtype = bool)
+    any_less = np.zeros((len(objectives), len(objectives)), dtype = bool)
+    for m in range(objectives.shape[1]):
+        column = objectives[:, m]
+        all_less_equal &= column[:, None] <= column[None, :]
+        any_less |= column[:, None] < column[None, :]
+    dominates = all_less_equal & any_less
+
+    dominated_by = dominates.sum(axis = 0)
+    ranks = np.full(len(objectives), -1, dtype = np.int64)
+    remaining = np.ones(len(objectives), dtype = bool)
+
+    rank = 0
+    while remaining.any():
+        front = remaining & (dominated_by == 0)
+        ranks[front] = rank
+        remaining &= ~front
+        # Remove the front so the next non-dominated individuals appear
+        dominated_by -= dominates[front].sum(axis = 0)
+        rank += 1
+
+    return ranks
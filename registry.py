@@ -0,0 +1,345 @@
+import logging
+import typing
+import numpy as np
+import pandas as pd
+from utils import START_PARAMS
+import strategies.obv, strategies.ichimoku, strategies.support_resistance
+import simulator
+
+logger = logging.getLogger()
+
+# Bars x parameter sets evaluated in one matrix (~160 MB of float64)
+BLOCK_CELLS = 20_000_000
+
+
+def bar_arrays(data: pd.DataFrame) -> typing.Dict[str, np.ndarray]:
+    # NumPy views of the OHLCV columns (no copy, the strategies must not write into them)
+    return {column: data[column].to_numpy() for column in ["open", "high", "low", "close", "volume"]}
+
+
+def trade_metrics(close: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    pnl (sum of the returns) and max drawdown (of the cumulative pnl) of each column of positions.
+    positions[i] is the position taken at bar i, NaN if the position does not change there:
+    each return is measured between two consecutive positions with the position of the first one
+    """
+    if len(close) == 0:
+        # No bars, no trade: same result as the strategy modules
+        return np.tile([0.0, np.nan], (positions.shape[1] if positions.ndim == 2 else 1, 1))
+
+    positions = positions.reshape(len(close), -1)
+    # Missing bars keep the last price, like pandas pct_change
+    prices = pd.Series(close).ffill().to_numpy()
+
+    if not np.isnan(positions).any():
+        returns = np.full(len(prices), np.nan)
+        returns[1:] = prices[1:] / prices[:-1] - 1
+        return _pnl_drawdown(returns, _shift(positions))
+
+    results = np.empty((positions.shape[1], 2))
+    for j in range(positions.shape[1]):
+        events = np.flatnonzero(~np.isnan(positions[:, j]))
+        event_prices = prices[events]
+        returns = np.full(len(events), np.nan)
+        returns[1:] = event_prices[1:] / event_prices[:-1] - 1
+        results[j] = _pnl_drawdown(returns, _shift(positions[events, j])[:, None])[0]
+
+    return results
+
+
+class Strategy:
+
+    """
+    Common protocol of the strategies: positions are computed from NumPy views
+    of the bars and the shared kernel (trade_metrics) turns them into pnl and
+    max drawdown, so every strategy can be backtested in batches. The positions
+    are ports of the strategy modules, checked against them (see reference)
+    """
+
+    name = None
+    # Changed with the code of a strategy whenever its results change, the cached results of other versions are not used
+    version = 1
+    # Options of the constructor (get_strategy), they change the results
+    option_names: typing.List[str] = []
+
+    def __init__(self):
+        self.params_data = START_PARAMS[self.name]
+        # Result of the comparison to the strategy module for each window of bars already checked
+        self._checked = dict()
+
+    def options(self) -> typing.Dict:
+        return {name: getattr(self, name) for name in self.option_names}
+
+    def key(self) -> typing.Tuple:
+        # Identifies the results of the strategy in the caches
+        return (self.name, self.version) + tuple(sorted(self.options().items()))
+
+    def reference(self, data: pd.DataFrame, params: typing.Dict) -> typing.Tuple[float, float]:
+        # Backtest of one set by the strategy module itself
+        raise NotImplementedError
+
+    def check_group(self, params: typing.Dict) -> typing.Tuple:
+        # Parameters the indicators of a set depend on: one set of each group is compared to the strategy module
+        return tuple(sorted(params.items()))
+
+    def positions(self, bars: typing.Dict[str, np.ndarray], params: typing.Dict) -> np.ndarray:
+        raise NotImplementedError
+
+    def positions_many(self, bars: typing.Dict[str, np.ndarray], params: typing.List[typing.Dict]) -> np.ndarray:
+        # One column per parameter set, strategies override it to share their indicators
+        return np.column_stack([self.positions(bars, p) for p in params])
+
+    def backtest(self, data: pd.DataFrame, params: typing.Dict) -> typing.Tuple[float, float]:
+        return self.backtest_many(data, [params])[0]
+
+    def backtest_many(self, data: pd.DataFrame, params: typing.List[typing.Dict],
+                      check: bool = True) -> typing.List[typing.Tuple[float, float]]:
+        # With check, one set of each group (check_group) is compared to the strategy module on these bars
+        if len(params) == 0:
+            return []
+
+        bars = bar_arrays(data)
+        results = []
+
+        for block in _blocks(len(data), len(params)):
+            positions = self.positions_many(bars, [params[i] for i in block])
+            results.extend((float(pnl), float(max_dd)) for pnl, max_dd in trade_metrics(bars["close"], positions))
+
+        if check and len(data) > 0:
+            groups = dict()
+            for i, p in enumerate(params):
+                groups.setdefault(self.check_group(p), []).append(i)
+
+            # The whole group is backtested by the strategy module when the port gives another result
+            for indexes in groups.values():
+                if not self.matches_reference(data, params[indexes[0]], results[indexes[0]]):
+                    for i in indexes:
+                        results[i] = self.reference(data, params[i])
+
+        return results
+
+    def matches_reference(self, data: pd.DataFrame, params: typing.Dict, result: typing.Tuple[float, float]) -> bool:
+        # Compared to the strategy module once per window of bars and group of parameters in each process
+        key = (len(data), data.index[0], data.index[-1], float(np.nansum(data["close"].to_numpy())), self.check_group(params))
+
+        if key not in self._checked:
+            expected = self.reference(data, params)
+            self._checked[key] = bool(np.allclose(np.asarray(result, dtype = "float64"), np.asarray(expected, dtype = "float64"),
+                                                  rtol = 1e-9, atol = 1e-12, equal_nan = True))
+            if not self._checked[key]:
+                logger.warning("%s port gives %s instead of %s for %s, the strategy module backtests this group on these bars",
+                               self.name, result, expected, params)
+
+        return self._checked[key]
+
+
+class Obv(Strategy):
+
+    # Long when the On Balance Volume is above its moving average, short otherwise
+    name = "obv"
+
+    def reference(self, data: pd.DataFrame, params: typing.Dict) -> typing.Tuple[float, float]:
+        # Shallow copy: the columns added by the module stay out of the shared bars
+        return strategies.obv.backtest(data.copy(deep = False), ma_period = params["ma_period"])
+
+    def positions(self, bars: typing.Dict[str, np.ndarray], params: typing.Dict) -> np.ndarray:
+        return self.positions_many(bars, [params])
+
+    def positions_many(self, bars: typing.Dict[str, np.ndarray], params: typing.List[typing.Dict]) -> np.ndarray:
+        # The OBV does not depend on ma_period, only its moving average does
+        close = pd.Series(bars["close"])
+        obv = (np.sign(close.diff()) * bars["volume"]).fillna(0).cumsum()
+
+        positions = np.empty((len(close), len(params)), order = "F")
+        for j, p in enumerate(params):
+            positions[:, j] = np.where(obv > obv.rolling(window = p["ma_period"]).mean(), 1, -1)
+
+        return positions
+
+
+class Ichimoku(Strategy):
+
+    # Tenkan / kijun cross confirmed by the cloud (senkou A and B) and the chikou span,
+    # a position is only taken on the bars of a confirmed cross
+    name = "ichimoku"
+
+    def reference(self, data: pd.DataFrame, params: typing.Dict) -> typing.Tuple[float, float]:
+        bars = data.copy(deep = False)
+        bars.columns = ["Open", "High", "Low", "Close", "Volume"]
+        return strategies.ichimoku.backtest(bars, tenkan_period = params["kijun"], kijun_period = params["tenkan"])
+
+    def positions(self, bars: typing.Dict[str, np.ndarray], params: typing.Dict) -> np.ndarray:
+        return self.positions_many(bars, [params])
+
+    def positions_many(self, bars: typing.Dict[str, np.ndarray], params: typing.List[typing.Dict]) -> np.ndarray:
+        high, low = pd.Series(bars["high"]), pd.Series(bars["low"])
+        close = bars["close"]
+        complete = ~np.isnan(np.column_stack([bars[column] for column in ["open", "high", "low", "close", "volume"]])).any(axis = 1)
+
+        # The midpoint of the high / low range of a window is the tenkan, the kijun or the senkou B line
+        # depending on the parameter set, so it is computed once per window
+        midpoints = dict()
+
+        def midpoint(window: int) -> np.ndarray:
+            if window not in midpoints:
+                midpoints[window] = ((high.rolling(window = window).max() + low.rolling(window = window).min()) / 2).to_numpy()
+            return midpoints[window]
+
+        positions = np.full((len(close), len(params)), np.nan, order = "F")
+        for j, p in enumerate(params):
+            # The kijun parameter is the tenkan period and the other way round, as in the first versions
+            tenkan_period, kijun_period = p["kijun"], p["tenkan"]
+
+            tenkan = midpoint(tenkan_period)
+            kijun = midpoint(kijun_period)
+            senkou_a = _shift((tenkan + kijun) / 2, kijun_period)
+            senkou_b = _shift(midpoint(kijun_period * 2), kijun_period)
+            chikou = _shift(close, kijun_period)
+
+            # Rows where every line exists, the cross is detected between two of them
+            rows = np.flatnonzero(complete & ~np.isnan(tenkan) & ~np.isnan(kijun) & ~np.isnan(senkou_a)
+                                  & ~np.isnan(senkou_b) & ~np.isnan(chikou))
+            c = close[rows]
+            difference = tenkan[rows] - kijun[rows]
+            previous = _shift(difference, 1)
+
+            with np.errstate(invalid = "ignore"):
+                long = (difference > 0) & (previous < 0) & (c > senkou_a[rows]) & (c > senkou_b[rows]) & (c > chikou[rows])
+                short = (difference < 0) & (previous > 0) & (c < senkou_a[rows]) & (c < senkou_b[rows]) & (c < chikou[rows])
+
+            positions[rows[long], j] = 1
+            positions[rows[short], j] = -1
+
+        return positions
+
+
+class SupportResistance(Strategy):
+
+    # Breakout of a support / resistance closed by a take profit or a stop loss: the trades depend on the path
+    # of the prices, so each parameter set goes through the trade simulator instead of the positions kernel
+    name = "sup_res"
+    # Fractions of the price: fee paid on both sides of a trade, slippage of each fill
+    option_names = ["fee", "slippage"]
+
+    def __init__(self, fee: float = 0.0, slippage: float = 0.0):
+        super().__init__()
+        self.fee = fee
+        self.slippage = slippage
+
+    def reference(self, data: pd.DataFrame, params: typing.Dict) -> typing.Tuple[float, float]:
+        return strategies.support_resistance.backtest(data.copy(deep = False), min_points = params["min_points"],
+                                                      min_diff_points = params["min_diff_points"], rounding_nb = params["rounding_nb"],
+                                                      take_profit = params["take_profit"], stop_loss = params["stop_loss"])
+
+    def check_group(self, params: typing.Dict) -> typing.Tuple:
+        # The levels and their breakouts, shared by every take profit / stop loss
+        return params["min_points"], params["min_diff_points"], params["rounding_nb"]
+
+    def trades(self, data: pd.DataFrame, params: typing.Dict) -> pd.DataFrame:
+        # Closed trades of one parameter set, to inspect a backtest
+        bars = bar_arrays(data)
+        signals = simulator.breakout_signals(bars["high"], bars["low"], bars["close"], params["min_points"],
+                                             params["min_diff_points"], params["rounding_nb"])
+        trades = simulator.simulate_trades(bars["open"], bars["high"], bars["low"], bars["close"], signals, params["take_profit"],
+                                           params["stop_loss"], self.fee, self.slippage)
+
+        return pd.DataFrame(trades, columns = simulator.TRADE_COLUMNS)
+
+    def backtest_many(self, data: pd.DataFrame, params: typing.List[typing.Dict],
+                      check: bool = True) -> typing.List[typing.Tuple[float, float]]:
+        if len(params) == 0:
+            return []
+
+        bars = {column: np.ascontiguousarray(values, dtype = np.float64) for column, values in bar_arrays(data).items()}
+
+        # The breakouts only depend on the levels parameters (check_group), they are shared by every take profit / stop loss
+        groups = dict()
+        for i, p in enumerate(params):
+            groups.setdefault(self.check_group(p), []).append(i)
+
+        results = [None] * len(params)
+        for (min_points, min_diff_points, rounding_nb), indexes in groups.items():
+            signals = simulator.breakout_signals(bars["high"], bars["low"], bars["close"], min_points, min_diff_points, rounding_nb)
+
+            for i in indexes:
+                results[i] = self._simulate(bars, signals, params[i], self.fee, self.slippage)
+
+            # The module only gives the pnl and max drawdown, which are the sum and the drawdown of the trade returns.
+            # It has no trading costs, so the trades are checked without them
+            if check and len(data) > 0:
+                i = indexes[0]
+                result = results[i] if self.fee == 0 and self.slippage == 0 else self._simulate(bars, signals, params[i], 0.0, 0.0)
+                if not self.matches_reference(data, params[i], result):
+                    if self.fee != 0 or self.slippage != 0:
+                        logger.warning("%s: the strategy module has no fee / slippage, the results of this group are without them",
+                                       self.name)
+                    for i in indexes:
+                        results[i] = self.reference(data, params[i])
+
+        return results
+
+    @staticmethod
+    def _simulate(bars: typing.Dict[str, np.ndarray], signals: np.ndarray, params: typing.Dict, fee: float,
+                  slippage: float) -> typing.Tuple[float, float]:
+        trades = simulator.simulate_trades(bars["open"], bars["high"], bars["low"], bars["close"], signals,
+                                           params["take_profit"], params["stop_loss"], fee, slippage)
+        # Each trade return counts once, like a position held between two events
+        pnl, max_dd = _pnl_drawdown(trades[:, 5], np.ones((len(trades), 1)))[0]
+        return float(pnl), float(max_dd)
+
+
+STRATEGIES = {strategy.name: strategy for strategy in [Obv(), Ichimoku(), SupportResistance()]}
+# Strategies created by get_strategy with options
+_with_options = dict()
+
+
+def strategy_options(name: str, values: typing.Dict) -> typing.Dict:
+    # The values of the options of the strategy (fee / slippage of a spec made for several strategies)
+    return {option: float(values[option]) for option in get_strategy(name).option_names if values.get(option) is not None}
+
+
+def get_strategy(name: str, **options) -> Strategy:
+    # The registered strategy, or the one with these options (see Strategy.option_names)
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown strategy {name}, choose among {list(STRATEGIES)}")
+    if len(options) == 0:
+        return STRATEGIES[name]
+
+    unknown = [option for option in options if option not in STRATEGIES[name].option_names]
+    if len(unknown) > 0:
+        raise ValueError(f"{name} has no options {unknown}, choose among {STRATEGIES[name].option_names}")
+
+    # Kept so the comparisons to the strategy module are not repeated
+    key = (name,) + tuple(sorted(options.items()))
+    if key not in _with_options:
+        _with_options[key] = type(STRATEGIES[name])(**options)
+    return _with_options[key]
+
+
+def _pnl_drawdown(returns: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    # Sum of the returns and maximum drawdown of the cumulative pnl of each column (NaN are skipped like pandas)
+    pnl = np.asfortranarray(returns[:, None] * positions)
+    missing = np.isnan(pnl)
+
+    total = np.where(missing, 0.0, pnl).sum(axis = 0)
+
+    cumulative = np.cumsum(np.where(missing, 0.0, pnl), axis = 0)
+    cumulative[missing] = np.nan
+    drawdown = np.fmax.accumulate(cumulative, axis = 0) - cumulative
+    max_dd = np.fmax.reduce(drawdown, axis = 0) if len(drawdown) > 0 else np.full(pnl.shape[1], np.nan)
+
+    return np.column_stack([total, max_dd])
+
+
+def _shift(values: np.ndarray, periods: int = 1) -> np.ndarray:
+    # pandas shift along the rows: the first rows become NaN
+    shifted = np.full(values.shape, np.nan, order = "F")
+    if periods < len(values):
+        shifted[periods:] = values[:len(values) - periods]
+    return shifted
+
+
+def _blocks(rows: int, columns: int) -> typing.List[typing.List[int]]:
+    # Parameter sets evaluated together so a block stays under BLOCK_CELLS cells
+    size = max(1, BLOCK_CELLS // max(rows, 1))
+    return [list(range(start, min(start + size, columns))) for start in range(0, columns, size)]
@@ -0,0 +1,161 @@
+import typing
+import numpy as np
+import pandas as pd
+
+# The loops are compiled when the optional numba package is installed, they run as plain Python otherwise
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Columns of the trades returned by simulate_trades
+TRADE_COLUMNS = ["entry_index", "exit_index", "side", "entry_price", "exit_price", "return"]
+
+
+def _jit(function: typing.Callable) -> typing.Callable:
+    # Same code in both modes, so the compiled loop gives the same trades as the Python one
+    return numba.njit(cache = True, nogil = True)(function) if numba is not None else function
+
+
+def breakout_signals(high: np.ndarray, low: np.ndarray, close: np.ndarray, min_points: int, min_diff_points: int,
+                     rounding_nb: float, compiled: bool = True) -> np.ndarray:
+    """
+    Support / resistance breakouts: 1 when the close crosses above a resistance, -1 when it crosses below a support, 0 otherwise.
+    The highs (resistances) and the lows (supports) are rounded to rounding_nb, a touch of a level counts when it comes
+    at least min_diff_points bars after the previous one and the level is confirmed after min_points touches.
+    A broken level is removed and has to be confirmed again
+    """
+    valid = ~np.isnan(high) & ~np.isnan(low) & ~np.isnan(close)
+    rounded_high = np.round(high / rounding_nb) * rounding_nb
+    rounded_low = np.round(low / rounding_nb) * rounding_nb
+
+    # Each rounded price becomes an index in the sorted levels
+    levels = np.unique(np.concatenate([rounded_high[valid], rounded_low[valid]]))
+    high_ids = np.where(valid, np.searchsorted(levels, rounded_high), -1)
+    low_ids = np.where(valid, np.searchsorted(levels, rounded_low), -1)
+
+    # Levels crossed by a bar: previous close <= level < close upwards, close < level <= previous close downwards
+    previous = pd.Series(np.where(valid, close, np.nan)).ffill().shift(1).to_numpy()
+    crossing = valid & ~np.isnan(previous)
+    up_start = np.where(crossing, np.searchsorted(levels, previous, "left"), 0)
+    up_end = np.where(crossing, np.searchsorted(levels, close, "left"), 0)
+    down_start = np.where(crossing, np.searchsorted(levels, close, "right"), 0)
+    down_end = np.where(crossing, np.searchsorted(levels, previous, "right"), 0)
+
+    loop = _breakout_loop if compiled else _breakout_loop_python
+    return loop(high_ids, low_ids, up_start, up_end, down_start, down_end, len(levels), min_points, min_diff_points)
+
+
+def simulate_trades(open_: np.ndarray, high: np.ndarray, low: np.ndarray, close: np.ndarray, signals: np.ndarray,
+                    take_profit: float, stop_loss: float, fee: float = 0.0, slippage: float = 0.0,
+                    compiled: bool = True) -> np.ndarray:
+    """
+    Bar by bar simulation of one position at a time, one row per closed trade (TRADE_COLUMNS).
+    A signal opens a position at the close of its bar when no position is open. The take profit and the stop loss
+    (% of the entry price) are checked from the next bar: at the open when the price gapped through them,
+    then against the low / high, the stop loss first when both are touched in the same bar.
+    slippage moves each fill against the trade and fee is paid on both sides (fractions of the price).
+    A position still open at the last bar is not counted
+    """
+    arrays = [np.ascontiguousarray(a, dtype = np.float64) for a in [open_, high, low, close]]
+    signals = np.ascontiguousarray(signals, dtype = np.int8)
+
+    loop = _simulate_loop if compiled else _simulate_loop_python
+    return loop(*arrays, signals, float(take_profit), float(stop_loss), float(fee), float(slippage))
+
+
+def _breakout_loop_python(high_ids: np.ndarray, low_ids: np.ndarray, up_start: np.ndarray, up_end: np.ndarray,
+                          down_start: np.ndarray, down_end: np.ndarray, size: int, min_points: int,
+                          min_diff_points: int) -> np.ndarray:
+    signals = np.zeros(len(high_ids), np.int8)
+
+    # Touches and last touched bar of every level, as a resistance and as a support
+    resistance_count = np.zeros(size, np.int64)
+    resistance_last = np.full(size, -min_diff_points, np.int64)
+    support_count = np.zeros(size, np.int64)
+    support_last = np.full(size, -min_diff_points, np.int64)
+
+    for i in range(len(high_ids)):
+        if high_ids[i] < 0:
+            continue
+
+        # Breakouts of the levels confirmed by the previous bars
+        for k in range(up_start[i], up_end[i]):
+            if resistance_count[k] >= min_points:
+                signals[i] = 1
+                resistance_count[k] = 0
+                resistance_last[k] = i - min_diff_points
+
+        for k in range(down_start[i], down_end[i]):
+            if support_count[k] >= min_points:
+                signals[i] = -1
+                support_count[k] = 0
+                support_last[k] = i - min_diff_points
+
+        k = high_ids[i]
+        if i - resistance_last[k] >= min_diff_points:
+            resistance_count[k] += 1
+        resistance_last[k] = i
+
+        k = low_ids[i]
+        if i - support_last[k] >= min_diff_points:
+            support_count[k] += 1
+        support_last[k] = i
+
+    return signals
+
+
+def _simulate_loop_python(open_: np.ndarray, high: np.ndarray, low: np.ndarray, close: np.ndarray, signals: np.ndarray,
+                          take_profit: float, stop_loss: float, fee: float, slippage: float) -> np.ndarray:
+    trades = np.empty((len(close), 6))
+    count = 0
+
+    side = 0
+    entry_index = 0
+    entry_price = 0.0
+    target = 0.0
+    stop = 0.0
+
+    for i in range(len(close)):
+        if side != 0:
+            exit_price = np.nan
+
+            # Bars with missing prices never match the comparisons
+            if side == 1:
+                if open_[i] <= stop or open_[i] >= target:
+                    exit_price = open_[i]
+                elif low[i] <= stop:
+                    exit_price = stop
+                elif high[i] >= target:
+                    exit_price = target
+            else:
+                if open_[i] >= stop or open_[i] <= target:
+                    exit_price = open_[i]
+                elif high[i] >= stop:
+                    exit_price = stop
+                elif low[i] <= target:
+                    exit_price = target
+
+            if not np.isnan(exit_price):
+                exit_price = exit_price * (1 - side * slippage)
+                trades[count, 0] = entry_index
+                trades[count, 1] = i
+                trades[count, 2] = side
+                trades[count, 3] = entry_price
+                trades[count, 4] = exit_price
+                trades[count, 5] = side * (exit_price / entry_price - 1) - fee * (1 + exit_price / entry_price)
+                count += 1
+                side = 0
+
+        if side == 0 and signals[i] != 0:
+            side = int(signals[i])
+            entry_index = i
+            entry_price = close[i] * (1 + side * slippage)
+            target = entry_price * (1 + side * take_profit / 100)
+            stop = entry_price * (1 - side * stop_loss / 100)
+
+    return trades[:count].copy()
+
+
+_breakout_loop = _jit(_breakout_loop_python)
+_simulate_loop = _jit(_simulate_loop_python)
@@ -0,0 +1,523 @@
+# Incremental indicators and backtests of the deployed parameter sets: the rolling state of each indicator is kept
+# (O(1) per bar) and saved, so after a collection run only the new bars are processed instead of the whole history.
+# Each stream gives the positions / trades of the batch strategy of registry.py on the same bars
+# Example: python streaming.py --exchange binance --symbol BTCUSDT --strategy obv --tf 1h --params deployed.json
+#          --state data/deployed_obv.pkl
+# deployed.json is a list of parameter sets, e.g. [{"ma_period": 20}, {"ma_period": 50}]
+
+import argparse
+import bisect
+import json
+import logging
+import math
+import os
+import pickle
+import typing
+from collections import deque
+import numpy as np
+import pandas as pd
+from database import open_reader
+from registry import get_strategy
+from utils import TF_MS
+
+logger = logging.getLogger()
+
+# Saved with the streams, a state of another version is rebuilt
+STATE_VERSION = 1
+
+
+class RollingMean:
+
+    """
+    pandas rolling(window).mean() one value at a time: same Kahan summation
+    (separate compensations for the added and removed values) and same
+    corrections, so the means are the ones of the batch strategies
+    """
+
+    def __init__(self, window: int):
+        self.window = window
+        self._values = deque()
+        self._reset()
+
+    def _reset(self):
+        self._nobs = 0
+        self._neg_ct = 0
+        self._sum = 0.0
+        self._compensation_add = 0.0
+        self._compensation_remove = 0.0
+        self._same_values = 0
+        self._previous = math.nan
+
+    def update(self, value: float) -> float:
+        if self.window == 1:
+            # pandas starts again from an empty sum when the windows do not overlap
+            self._reset()
+
+        # The value leaving the window is removed before the new one is added, like pandas
+        if len(self._values) == self.window:
+            old = self._values.popleft()
+            if old == old:
+                self._nobs -= 1
+                y = -old - self._compensation_remove
+                t = self._sum + y
+                self._compensation_remove = t - self._sum - y
+                self._sum = t
+                if math.copysign(1.0, old) < 0:
+                    self._neg_ct -= 1
+
+        self._values.append(value)
+        if value == value:
+            self._nobs += 1
+            y = value - self._compensation_add
+            t = self._sum + y
+            self._compensation_add = t - self._sum - y
+            self._sum = t
+            if math.copysign(1.0, value) < 0:
+                self._neg_ct += 1
+            # A window of the same value gives this value exactly
+            self._same_values = self._same_values + 1 if value == self._previous else 1
+            self._previous = value
+
+        if self._nobs < self.window:
+            return math.nan
+
+        result = self._sum / self._nobs
+        if self._same_values >= self._nobs:
+            result = self._previous
+        elif self._neg_ct == 0 and result < 0:
+            result = 0.0
+        elif self._neg_ct == self._nobs and result > 0:
+            result = 0.0
+
+        return result
+
+
+class RollingExtremum:
+
+    # pandas rolling(window).max() (or min()) with a monotonic queue: NaN while the window has a missing value
+    def __init__(self, window: int, maximum: bool = True):
+        self.window = window
+        self.maximum = maximum
+        self._index = -1
+        self._candidates = deque()
+        self._missing = deque()
+
+    def update(self, value: float) -> float:
+        self._index += 1
+        first = self._index - self.window + 1
+
+        if value != value:
+            self._missing.append(self._index)
+        else:
+            # Values that can not be the extremum of a later window are dropped
+            while len(self._candidates) > 0 and (self._candidates[-1][1] <= value if self.maximum else self._candidates[-1][1] >= value):
+                self._candidates.pop()
+            self._candidates.append((self._index, value))
+
+        while len(self._candidates) > 0 and self._candidates[0][0] < first:
+            self._candidates.popleft()
+        while len(self._missing) > 0 and self._missing[0] < first:
+            self._missing.popleft()
+
+        if first < 0 or len(self._missing) > 0:
+            return math.nan
+
+        return self._candidates[0][1]
+
+
+class Shift:
+
+    # Value of periods bars before (NaN for the first bars), like pandas shift
+    def __init__(self, periods: int):
+        self.periods = periods
+        self._values = deque(maxlen = periods)
+
+    def update(self, value: float) -> float:
+        if self.periods == 0:
+            return value
+
+        result = self._values[0] if len(self._values) == self.periods else math.nan
+        self._values.append(value)
+
+        return result
+
+
+class TradeMetrics:
+
+    """
+    Running pnl and max drawdown of the cumulative pnl, NaN returns are
+    skipped like the metrics kernel of registry.py. The pnl is the running
+    sum, the batch kernel sums the same returns pairwise (last digits can differ)
+    """
+
+    def __init__(self):
+        self.pnl = 0.0
+        self.max_dd = math.nan
+        self._peak = math.nan
+
+    def add(self, value: float):
+        if value != value:
+            return
+
+        self.pnl += value
+        self._peak = self.pnl if self._peak != self._peak else max(self._peak, self.pnl)
+        drawdown = self._peak - self.pnl
+        self.max_dd = drawdown if self.max_dd != self.max_dd else max(self.max_dd, drawdown)
+
+
+class PositionMetrics(TradeMetrics):
+
+    # Positions taken at some bars (NaN elsewhere): each return is measured between two positions with the first one
+    def __init__(self):
+        super().__init__()
+        self._price = math.nan
+        self._event_price = math.nan
+        self._position = math.nan
+
+    def update(self, close: float, position: float):
+        # Missing bars keep the last price
+        if close == close:
+            self._price = close
+
+        if position != position:
+            return
+
+        if self._position == self._position:
+            self.add((self._price / self._event_price - 1) * self._position)
+
+        self._event_price = self._price
+        self._position = position
+
+
+class Stream:
+
+    """
+    Incremental backtest of one parameter set: update() takes the bars following
+    the ones already processed and returns the pnl and max drawdown from the first bar
+    """
+
+    name = None
+
+    def __init__(self, params: typing.Dict):
+        self.params = params
+        self.bars = 0
+        self.last_timestamp = None
+
+    def update(self, data: pd.DataFrame) -> typing.Tuple[float, float]:
+        if len(data) > 0:
+            if self.last_timestamp is not None and data.index[0] <= self.last_timestamp:
+                raise ValueError(f"Bars from {data.index[0]} were already processed (last one: {self.last_timestamp})")
+
+            columns = [data[column].to_numpy(dtype = np.float64).tolist() for column in ["open", "high", "low", "close", "volume"]]
+            for bar in zip(*columns):
+                self.update_bar(*bar)
+                self.bars += 1
+
+            self.last_timestamp = data.index[-1]
+
+        return self.result()
+
+    def update_bar(self, open_: float, high: float, low: float, close: float, volume: float):
+        raise NotImplementedError
+
+    def result(self) -> typing.Tuple[float, float]:
+        raise NotImplementedError
+
+
+class ObvStream(Stream):
+
+    name = "obv"
+
+    def __init__(self, params: typing.Dict):
+        super().__init__(params)
+        self.obv = 0.0
+        self._close = math.nan
+        self._ma = RollingMean(params["ma_period"])
+        self._metrics = PositionMetrics()
+
+    def update_bar(self, open_: float, high: float, low: float, close: float, volume: float):
+        # The bars after a missing close or volume do not move the OBV, like the fillna(0) of the batch version
+        change = float(np.sign(close - self._close)) * volume
+        self.obv += change if change == change else 0.0
+        self._close = close
+
+        ma = self._ma.update(self.obv)
+        self._metrics.update(close, 1.0 if self.obv > ma else -1.0)
+
+    def result(self) -> typing.Tuple[float, float]:
+        return self._metrics.pnl, self._metrics.max_dd
+
+
+class IchimokuStream(Stream):
+
+    name = "ichimoku"
+
+    def __init__(self, params: typing.Dict):
+        super().__init__(params)
+        # The kijun parameter is the tenkan period and the other way round, as in the batch version
+        tenkan_period, kijun_period = params["kijun"], params["tenkan"]
+
+        self._tenkan = [RollingExtremum(tenkan_period, True), RollingExtremum(tenkan_period, False)]
+        self._kijun = [RollingExtremum(kijun_period, True), RollingExtremum(kijun_period, False)]
+        self._senkou_b = [RollingExtremum(kijun_period * 2, True), RollingExtremum(kijun_period * 2, False)]
+        self._senkou_a_shift = Shift(kijun_period)
+        self._senkou_b_shift = Shift(kijun_period)
+        self._chikou_shift = Shift(kijun_period)
+
+        self._previous_difference = math.nan
+        self._metrics = PositionMetrics()
+
+    def update_bar(self, open_: float, high: float, low: float, close: float, volume: float):
+        tenkan = (self._tenkan[0].update(high) + self._tenkan[1].update(low)) / 2
+        kijun = (self._kijun[0].update(high) + self._kijun[1].update(low)) / 2
+        senkou_a = self._senkou_a_shift.update((tenkan + kijun) / 2)
+        senkou_b = self._senkou_b_shift.update((self._senkou_b[0].update(high) + self._senkou_b[1].update(low)) / 2)
+        chikou = self._chikou_shift.update(close)
+
+        position = math.nan
+
+        # The cross is detected between two bars where every line exists
+        if not any(math.isnan(v) for v in [open_, high, low, close, volume, tenkan, kijun, senkou_a, senkou_b, chikou]):
+            difference = tenkan - kijun
+            previous = self._previous_difference
+            self._previous_difference = difference
+
+            if difference > 0 and previous < 0 and close > senkou_a and close > senkou_b and close > chikou:
+                position = 1.0
+            elif difference < 0 and previous > 0 and close < senkou_a and close < senkou_b and close < chikou:
+                position = -1.0
+
+        self._metrics.update(close, position)
+
+    def result(self) -> typing.Tuple[float, float]:
+        return self._metrics.pnl, self._metrics.max_dd
+
+
+class SupportResistanceStream(Stream):
+
+    """
+    sup_res of registry.py bar by bar: the support / resistance levels of
+    simulator.breakout_signals and the trade of simulator.simulate_trades.
+    A trade counts once it is closed
+    """
+
+    name = "sup_res"
+
+    def __init__(self, params: typing.Dict, fee: float = 0.0, slippage: float = 0.0):
+        super().__init__(params)
+        self.fee = fee
+        self.slippage = slippage
+
+        # Touches and last touched bar of each level, confirmed levels sorted to find the crossed ones
+        self._resistances = dict()
+        self._supports = dict()
+        self._confirmed_resistances = []
+        self._confirmed_supports = []
+        self._previous_close = math.nan
+
+        # Open trade
+        self._side = 0
+        self._entry_price = 0.0
+        self._target = 0.0
+        self._stop = 0.0
+
+        self._metrics = TradeMetrics()
+
+    def update_bar(self, open_: float, high: float, low: float, close: float, volume: float):
+        signal = self._breakout(high, low, close)
+        self._simulate(open_, high, low, close, signal)
+
+    def _breakout(self, high: float, low: float, close: float) -> int:
+        i = self.bars
+        min_points, min_diff_points, rounding_nb = self.params["min_points"], self.params["min_diff_points"], self.params["rounding_nb"]
+
+        if math.isnan(high) or math.isnan(low) or math.isnan(close):
+            return 0
+
+        signal = 0
+        previous = self._previous_close
+        self._previous_close = close
+
+        if previous == previous:
+            # Upwards: previous close <= level < close
+            start = bisect.bisect_left(self._confirmed_resistances, previous)
+            end = bisect.bisect_left(self._confirmed_resistances, close)
+            for level in self._confirmed_resistances[start:end]:
+                self._resistances[level] = [0, i - min_diff_points]
+                signal = 1
+            del self._confirmed_resistances[start:end]
+
+            # Downwards: close < level <= previous close
+            start = bisect.bisect_right(self._confirmed_supports, close)
+            end = bisect.bisect_right(self._confirmed_supports, previous)
+            for level in self._confirmed_supports[start:end]:
+                self._supports[level] = [0, i - min_diff_points]
+                signal = -1
+            del self._confirmed_supports[start:end]
+
+        # Rounded like the batch version so the levels are the same floats
+        for levels, confirmed, price in [(self._resistances, self._confirmed_resistances, high),
+                                         (self._supports, self._confirmed_supports, low)]:
+            level = float(np.round(price / rounding_nb) * rounding_nb)
+            touches = levels.setdefault(level, [0, -min_diff_points])
+            if i - touches[1] >= min_diff_points:
+                touches[0] += 1
+                if touches[0] == min_points:
+                    bisect.insort(confirmed, level)
+            touches[1] = i
+
+        return signal
+
+    def _simulate(self, open_: float, high: float, low: float, close: float, signal: int):
+        side = self._side
+
+        if side != 0:
+            exit_price = math.nan
+
+            if side == 1:
+                if open_ <= self._stop or open_ >= self._target:
+                    exit_price = open_
+                elif low <= self._stop:
+                    exit_price = self._stop
+                elif high >= self._target:
+                    exit_price = self._target
+            else:
+                if open_ >= self._stop or open_ <= self._target:
+                    exit_price = open_
+                elif high >= self._stop:
+                    exit_price = self._stop
+                elif low <= self._target:
+                    exit_price = self._target
+
+            if exit_price == exit_price:
+                exit_price = exit_price * (1 - side * self.slippage)
+                self._metrics.add(side * (exit_price / self._entry_price - 1) - self.fee * (1 + exit_price / self._entry_price))
+                self._side = 0
+
+        if self._side == 0 and signal != 0:
+            self._side = signal
+            self._entry_price = close * (1 + signal * self.slippage)
+            self._target = self._entry_price * (1 + signal * self.params["take_profit"] / 100)
+            self._stop = self._entry_price * (1 - signal * self.params["stop_loss"] / 100)
+
+    def result(self) -> typing.Tuple[float, float]:
+        return self._metrics.pnl, self._metrics.max_dd
+
+
+STREAMS = {stream.name: stream for stream in [ObvStream, IchimokuStream, SupportResistanceStream]}
+
+
+def create_stream(strategy: str, params: typing.Dict, **options) -> Stream:
+    # options: fee / slippage of the strategies that have them, checked like the batch strategies
+    if strategy not in STREAMS:
+        raise ValueError(f"Unknown strategy {strategy}, choose among {list(STREAMS)}")
+    get_strategy(strategy, **options)
+    return STREAMS[strategy](params, **options)
+
+
+def _check_streams(strategy: str, data: pd.DataFrame, streams: typing.Dict[typing.Tuple, Stream], options: typing.Dict):
+    # The new streams are compared to the batch backtests of the same bars (themselves checked against the strategy modules)
+    expected = get_strategy(strategy, **options).backtest_many(data, [dict(key) for key in streams])
+
+    for (key, stream), result in zip(streams.items(), expected):
+        if not np.allclose(stream.result(), result, rtol = 1e-9, atol = 1e-12, equal_nan = True):
+            logger.warning("%s stream gives %s instead of %s for %s", strategy, stream.result(), result, dict(key))
+
+
+def update_deployed(exchange: str, symbol: str, strategy: str, tf: str, params: typing.List[typing.Dict], state_path: str,
+                    from_time: int = 0, options: typing.Optional[typing.Dict] = None) -> typing.List[typing.Tuple[float, float]]:
+    """
+    pnl and max drawdown of each parameter set from from_time to the last complete bar.
+    The streams saved in state_path continue from the bar after their last one, the new
+    parameter sets start from from_time, and the updated streams are saved back.
+    The state is rebuilt if candles were inserted before the last processed bar (backfill).
+    The streams of the new sets are checked against the batch backtests.
+    options are the fee / slippage of the strategies that have them
+    """
+    h5_db = open_reader(exchange, symbol, tf)
+
+    if symbol not in h5_db.hf:
+        raise ValueError(f"No {exchange} {symbol} candles")
+
+    first_ts, last_ts = h5_db.get_first_last_timestamp(symbol)
+    if first_ts is None:
+        raise ValueError(f"No {exchange} {symbol} candles")
+
+    # Start of the first incomplete bar: a bar is only processed once all its candles can exist
+    end_bar = int(last_ts + TF_MS["1m"]) - int(last_ts + TF_MS["1m"]) % TF_MS[tf]
+    start_bar = from_time - from_time % TF_MS[tf]
+
+    options = dict() if options is None else dict(options)
+    run = {"exchange": exchange, "symbol": symbol, "strategy": strategy, "tf": tf, "from_time": start_bar, "options": options}
+    streams = dict()
+    next_bar = start_bar
+
+    if os.path.exists(state_path):
+        with open(state_path, "rb") as f:
+            state = pickle.load(f)
+
+        if state["version"] != STATE_VERSION or state["run"] != run:
+            logger.warning("%s was saved for another run (%s), the streams are rebuilt", state_path, state["run"])
+        elif state["raw_first_ts"] != first_ts or h5_db.count_candles(symbol, state["next_bar"] - 1) != state["raw_rows"]:
+            logger.warning("%s %s candles were inserted before %s, the streams are rebuilt", exchange, symbol, state["next_bar"])
+        else:
+            streams = state["streams"]
+            next_bar = state["next_bar"]
+
+    keys = [tuple(sorted(p.items())) for p in params]
+    resumed = [key for key in dict.fromkeys(keys) if key in streams]
+    new = [key for key in dict.fromkeys(keys) if key not in streams]
+
+    # Streams of parameter sets that are no longer deployed are dropped
+    streams = {key: streams[key] for key in resumed}
+    for key in new:
+        streams[key] = create_stream(strategy, dict(key), **options)
+
+    # The new parameter sets go through the whole history, the others only through the new bars
+    for window_start, window_keys in [(start_bar, new), (next_bar, resumed)]:
+        if len(window_keys) == 0 or window_start >= end_bar:
+            continue
+
+        data = h5_db.get_resampled_data(symbol, tf, window_start, end_bar - 1)
+        for key in window_keys:
+            streams[key].update(data)
+
+        if window_start == start_bar:
+            _check_streams(strategy, data, {key: streams[key] for key in window_keys}, options)
+
+        logger.info("%s %s %s: %s bars processed for %s parameter sets", strategy, symbol, tf, len(data), len(window_keys))
+
+    state = {"version": STATE_VERSION, "run": run, "next_bar": max(end_bar, start_bar), "raw_first_ts": first_ts,
+             "raw_rows": h5_db.count_candles(symbol, max(end_bar, start_bar) - 1), "streams": streams}
+
+    # Write to a temporary file first so a crash while saving keeps the previous state
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(state, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, state_path)
+
+    return [streams[key].result() for key in keys]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s :: %(message)s")
+
+    parser = argparse.ArgumentParser(description = "Incremental backtest of the deployed parameter sets")
+    parser.add_argument("--exchange", required = True, choices = ["ftx", "binance"])
+    parser.add_argument("--symbol", required = True)
+    parser.add_argument("--strategy", required = True, choices = list(STREAMS))
+    parser.add_argument("--tf", required = True, choices = list(TF_MS))
+    parser.add_argument("--params", required = True, help = "JSON file with the list of parameter sets")
+    parser.add_argument("--state", required = True, help = "State file of the streams (created on the first run)")
+    parser.add_argument("--from", dest = "from_time", type = int, default = 0, help = "Start of the backtests in milliseconds")
+    parser.add_argument("--fee", type = float, help = "Fee paid on both sides of a trade (sup_res), fraction of the price")
+    parser.add_argument("--slippage", type = float, help = "Slippage of each fill (sup_res), fraction of the price")
+    args = parser.parse_args()
+
+    with open(args.params) as f:
+        deployed = json.load(f)
+
+    results = update_deployed(args.exchange, args.symbol, args.strategy, args.tf, deployed, args.state, args.from_time,
+                              {option: getattr(args, option) for option in ["fee", "slippage"] if getattr(args, option) is not None})
+
+    print(pd.DataFrame([dict(p, pnl = pnl, max_dd = max_dd) for p, (pnl, max_dd) in zip(deployed, results)]))
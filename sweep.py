@@ -0,0 +1,51 @@
+import typing
+import numpy as np
+import pandas as pd
+from registry import get_strategy
+from utils import START_PARAMS
+
+
+def grid_values(strategy: str, name: str, points: int = 10) -> typing.List:
+    # Values spread evenly over the START_PARAMS range of the parameter, bounds included
+    value = START_PARAMS[strategy][name]
+    values = np.linspace(value["min"], value["max"], points)
+
+    if value["type"] == int:
+        return [int(v) for v in np.unique(np.round(values))]
+    return [float(v) for v in np.unique(np.round(values, value["decimals"]))]
+
+
+def random_params(strategy: str, size: int, rng: typing.Optional[np.random.Generator] = None) -> typing.List[typing.Dict]:
+    # Uniform draws in the START_PARAMS ranges, like the initial population of Nsga2
+    rng = np.random.default_rng() if rng is None else rng
+    columns = dict()
+
+    for name, value in START_PARAMS[strategy].items():
+        if value["type"] == int:
+            columns[name] = [int(v) for v in rng.integers(value["min"], value["max"] + 1, size)]
+        else:
+            columns[name] = [float(v) for v in np.round(rng.uniform(value["min"], value["max"], size), value["decimals"])]
+
+    return [dict(zip(columns.keys(), row)) for row in zip(*columns.values())]
+
+
+def backtest_many(strategy: str, data: pd.DataFrame, params: typing.List[typing.Dict], check: bool = True,
+                  options: typing.Optional[typing.Dict] = None) -> typing.List[typing.Tuple[float, float]]:
+    """
+    Backtest a list of parameter sets on the same bars. The strategies compute
+    each indicator once for all the sets that use it and the positions of
+    a whole block of sets go through the metrics kernel together. With check,
+    one set of each indicator group is compared to the strategy module itself
+    and the group falls back to it if they differ. options are the fee /
+    slippage of the strategies that have them.
+    """
+    if len(params) == 0:
+        return []
+
+    # Repeated combinations are evaluated once
+    keys = [tuple(sorted(p.items())) for p in params]
+    unique = list(dict.fromkeys(keys))
+
+    by_key = dict(zip(unique, get_strategy(strategy, **(options or dict())).backtest_many(data, [dict(key) for key in unique], check)))
+
+    return [by_key[key] for key in keys]
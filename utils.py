@@ -1,9 +1,19 @@
 import datetime
+import typing
+from multiprocessing import shared_memory
+import numpy as np
 import pandas as pd
 
 TF_EQUIV = {"1m": "1Min", "5m": "5Min", "15m": "15Min", "30m": "30Min", "1h": "1H", "4h": "4H",
             "12h": "12H", "1d": "D"}
 
+# Length of each timeframe in milliseconds
+TF_MS = {"1m": 60_000, "5m": 300_000, "15m": 900_000, "30m": 1_800_000, "1h": 3_600_000, "4h": 14_400_000,
+         "12h": 43_200_000, "1d": 86_400_000}
+
+# Timeframes whose bars are cached in the database
+RESAMPLED_TFS = ["5m", "15m", "30m", "1h", "4h", "12h", "1d"]
+
 START_PARAMS = {
     
     "obv": {
@@ -34,4 +44,97 @@ def resample_timeframe(data: pd.DataFrame, tf: str) -> pd.DataFrame:
         "low": "min", # From all prices between t and t + tf keep the min
         "close": "last",  # From all prices between t and t + tf keep the last
         "volume": "sum"  # From all prices between t and t + tf keep the sum of all of them
-        })
\ No newline at end of file
+        })
+
+def resample_array(data: np.ndarray, tf: str) -> np.ndarray:
+    """
+    Same bars as resample_timeframe, computed on the raw (timestamp, open, high, low, close, volume)
+    rows of the database. Rows must be sorted by timestamp.
+    """
+    if len(data) == 0:
+        return np.empty((0, 6))
+    
+    # Bars are aligned on multiples of the timeframe (midnight for 1d) like pandas
+    buckets = data[:, 0].astype(np.int64) // TF_MS[tf]
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    ends = np.append(starts[1:], len(data))
+    
+    # Every bar between the first and the last one exists, empty ones are NaN with a volume of 0
+    positions = buckets[starts] - buckets[0]
+    bars = np.full((positions[-1] + 1, 6), np.nan)
+    bars[:, 0] = (buckets[0] + np.arange(len(bars))) * TF_MS[tf]
+    bars[:, 5] = 0.0
+    
+    bars[positions, 1] = data[starts, 1] # From all prices between t and t + tf keep the first
+    bars[positions, 2] = np.maximum.reduceat(data[:, 2], starts) # keep the max
+    bars[positions, 3] = np.minimum.reduceat(data[:, 3], starts) # keep the min
+    bars[positions, 4] = data[ends - 1, 4] # keep the last
+    bars[positions, 5] = _segment_sum(data[:, 5], starts, ends) # keep the sum of all of them
+    
+    return bars
+
+
+def _segment_sum(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # Kahan summation of each segment, in the same order as pandas so the sums are identical.
+    # The segments are the columns of a padded matrix and advance together, one row per step.
+    lengths = ends - starts
+    steps = np.arange(lengths.max())[:, None]
+    inside = steps < lengths[None, :]
+    matrix = values[np.where(inside, starts[None, :] + steps, 0)]
+    
+    sums = np.zeros(len(starts))
+    compensation = np.zeros(len(starts))
+    
+    for k in range(len(matrix)):
+        y = matrix[k] - compensation
+        t = sums + y
+        compensation = np.where(inside[k], (t - sums) - y, compensation)
+        sums = np.where(inside[k], t, sums)
+        
+    return sums
+
+
+class SharedFrame:
+    
+    """
+    Places a float64 DataFrame in shared memory once so worker processes can
+    map it instead of receiving a pickled copy with every task
+    """
+    
+    def __init__(self, data: pd.DataFrame):
+        values = np.ascontiguousarray(data.to_numpy(dtype = "float64"))
+        index = np.ascontiguousarray(data.index.values)
+        
+        # SharedMemory does not accept a size of 0
+        self._values_shm = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+        self._index_shm = shared_memory.SharedMemory(create = True, size = max(index.nbytes, 1))
+        
+        np.ndarray(values.shape, dtype = values.dtype, buffer = self._values_shm.buf)[:] = values
+        np.ndarray(index.shape, dtype = index.dtype, buffer = self._index_shm.buf)[:] = index
+        
+        # Everything a worker needs to rebuild the frame (small and picklable)
+        self.spec = {"values": self._values_shm.name, "index": self._index_shm.name, "shape": values.shape,
+                     "index_dtype": index.dtype.str, "columns": list(data.columns),
+                     "freq": getattr(data.index, "freqstr", None), "index_name": data.index.name}
+    
+    def close(self):
+        self._values_shm.close()
+        self._values_shm.unlink()
+        self._index_shm.close()
+        self._index_shm.unlink()
+
+
+def attach_shared_frame(spec: typing.Dict) -> typing.Tuple[pd.DataFrame, typing.List[shared_memory.SharedMemory]]:
+    # The returned handles must be kept alive as long as the DataFrame is used
+    values_shm = shared_memory.SharedMemory(name = spec["values"])
+    index_shm = shared_memory.SharedMemory(name = spec["index"])
+    
+    values = np.ndarray(spec["shape"], dtype = "float64", buffer = values_shm.buf)
+    # Read only so a strategy cannot modify the data seen by the other workers
+    values.flags.writeable = False
+    index = np.ndarray((spec["shape"][0],), dtype = np.dtype(spec["index_dtype"]), buffer = index_shm.buf)
+    
+    index = pd.DatetimeIndex(index, freq = spec["freq"], name = spec["index_name"])
+    data = pd.DataFrame(values, index = index, columns = spec["columns"], copy = False)
+    
+    return data, [values_shm, index_shm]
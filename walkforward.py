@@ -0,0 +1,166 @@
+# Walk-forward / k-fold validation of the optimizer: the bars of the whole period are loaded once,
+# each fold optimizes on its in-sample slice and backtests the final Pareto front on its out-of-sample slice
+# Example: python walkforward.py --exchange binance --symbol BTCUSDT --strategy obv --tf 1h --from 2020-01-01
+#          --folds 5 --scheme anchored --population-size 50 --generations 10 --output folds.parquet
+#
+# Schemes (the period is cut in equal parts):
+# anchored: the in-sample slice starts at the beginning and grows, the out-of-sample slice is the next part
+# rolling: the in-sample slice is the previous part only
+# kfold: each part is out-of-sample once, the parts before and after it are the in-sample data (backtested separately)
+
+import argparse
+import logging
+import os
+import typing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from batch import parse_time, share_window, window_data, write_results, STRATEGIES
+from utils import TF_EQUIV
+import optimizer
+import sweep
+
+logger = logging.getLogger()
+
+SCHEMES = ["anchored", "rolling", "kfold"]
+
+
+def make_folds(size: int, folds: int, scheme: str = "anchored") -> typing.List[typing.Dict]:
+    """
+    Row ranges of each fold: "train" is a list of (start, end) ranges, "test" one (start, end) range
+    """
+    if scheme not in SCHEMES:
+        raise ValueError(f"Unknown scheme {scheme}, choose among {SCHEMES}")
+
+    # The first part of the walk-forward schemes is only used in-sample
+    parts = folds if scheme == "kfold" else folds + 1
+    if size < parts * 2:
+        raise ValueError(f"{size} bars can not be split in {parts} parts")
+    bounds = np.linspace(0, size, parts + 1).astype(int)
+
+    result = []
+    for i in range(folds):
+        if scheme == "kfold":
+            test = (bounds[i], bounds[i + 1])
+            train = [r for r in [(bounds[0], bounds[i]), (bounds[i + 1], bounds[-1])] if r[1] > r[0]]
+        else:
+            test = (bounds[i + 1], bounds[i + 2])
+            train = [(bounds[0] if scheme == "anchored" else bounds[i], bounds[i + 1])]
+        result.append({"fold": i, "train": [(int(s), int(e)) for s, e in train], "test": (int(test[0]), int(test[1]))})
+
+    return result
+
+
+def walk_forward(exchange: str, symbol: str, strategy: str, tf: str, from_time: int, to_time: int, folds: int,
+                 population_size: int, generations: int, scheme: str = "anchored", jobs: int = 1,
+                 seed: typing.Optional[int] = None, options: typing.Optional[typing.Dict] = None) -> pd.DataFrame:
+    """
+    One row per individual of the final Pareto front of each fold, with its
+    in-sample (is_) and out-of-sample (oos_) pnl and max drawdown.
+    options are the fee / slippage of the strategies that have them
+    """
+    shared = []
+
+    try:
+        # Read and resampled once for every fold
+        spec = share_window(exchange, symbol, tf, from_time, to_time, shared)
+        if spec is None:
+            raise ValueError(f"No {exchange} {symbol} {tf} bars from {from_time} to {to_time}")
+
+        size = spec["shape"][0] if "shape" in spec else len(window_data(spec))
+        tasks = [dict(fold, exchange = exchange, symbol = symbol, strategy = strategy, tf = tf, data = spec,
+                      population_size = population_size, generations = generations, options = options,
+                      seed = None if seed is None else seed + fold["fold"]) for fold in make_folds(size, folds, scheme)]
+
+        logger.info("%s %s %s: %s folds (%s) of %s bars on %s processes", strategy, symbol, tf, folds, scheme, size, jobs)
+
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            results = list(executor.map(_run_fold, tasks))
+    finally:
+        for frame in shared:
+            frame.close()
+
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+def summarize(results: pd.DataFrame) -> pd.DataFrame:
+    # Per fold: size of the front, out-of-sample results of the best in-sample individual and of the whole front
+    summary = []
+    for fold, front in results.groupby("fold"):
+        best = front.loc[front["is_pnl"].idxmax()]
+        summary.append({"fold": fold, "front_size": len(front), "best_is_pnl": best["is_pnl"], "best_oos_pnl": best["oos_pnl"],
+                        "best_oos_max_dd": best["oos_max_dd"], "mean_oos_pnl": front["oos_pnl"].mean(),
+                        "worst_oos_max_dd": front["oos_max_dd"].max()})
+
+    return pd.DataFrame(summary)
+
+
+def _run_fold(task: typing.Dict) -> typing.List[typing.Dict]:
+    data = window_data(task["data"])
+
+    # Slices of the shared bars (zero-copy)
+    parts = [data.iloc[start:end] for start, end in task["train"]]
+    test = data.iloc[task["test"][0]:task["test"][1]]
+
+    times = {"train_from": _ms(parts[0].index[0]), "train_to": _ms(parts[-1].index[-1]),
+             "test_from": _ms(test.index[0]), "test_to": _ms(test.index[-1])}
+
+    if len(parts) == 1:
+        symbol, train = task["symbol"], parts[0]
+    else:
+        # The two parts of a k-fold in-sample set are not joined: the return across the join would be the move
+        # of the test fold and the indicators would run over it. They are backtested separately as a basket
+        # (mean pnl, worst drawdown), the in-sample pnl is the sum of the pnl of the parts
+        symbol = [f"{task['symbol']}:{start}-{end}" for start, end in task["train"]]
+        train = dict(zip(symbol, parts))
+
+    # The fold window is part of the fitness cache key
+    nsga2 = optimizer.Nsga2(task["exchange"], symbol, task["strategy"], task["tf"], times["train_from"], times["train_to"],
+                            task["population_size"], seed = task["seed"], data = train, options = task["options"])
+    population = nsga2.optimize(task["generations"])
+    nsga2.close()
+
+    front = [bt for bt in population if bt.rank == 0]
+    out_of_sample = sweep.backtest_many(task["strategy"], test, [bt.parameters for bt in front], options = task["options"])
+
+    logger.info("%s %s %s: fold %s done, %s individuals on the front", task["strategy"], task["symbol"], task["tf"],
+                task["fold"], len(front))
+
+    return [dict({"fold": task["fold"]}, **times, **bt.parameters, is_pnl = bt.pnl * len(parts), is_max_dd = bt.max_dd,
+                 oos_pnl = pnl, oos_max_dd = max_dd) for bt, (pnl, max_dd) in zip(front, out_of_sample)]
+
+
+def _ms(timestamp: pd.Timestamp) -> int:
+    return int(timestamp.value // 1_000_000)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(levelname)s :: %(message)s")
+
+    parser = argparse.ArgumentParser(description = "Walk-forward / k-fold validation of the optimizer")
+    parser.add_argument("--exchange", required = True, choices = ["ftx", "binance"])
+    parser.add_argument("--symbol", required = True)
+    parser.add_argument("--strategy", required = True, choices = STRATEGIES)
+    parser.add_argument("--tf", required = True, choices = list(TF_EQUIV))
+    parser.add_argument("--from", dest = "from_time", help = "yyyy-mm-dd or milliseconds")
+    parser.add_argument("--to", dest = "to_time", help = "yyyy-mm-dd or milliseconds")
+    parser.add_argument("--folds", type = int, default = 5)
+    parser.add_argument("--scheme", choices = SCHEMES, default = "anchored")
+    parser.add_argument("--population-size", type = int, default = 50)
+    parser.add_argument("--generations", type = int, default = 10)
+    parser.add_argument("--fee", type = float, help = "Fee paid on both sides of a trade (sup_res), fraction of the price")
+    parser.add_argument("--slippage", type = float, help = "Slippage of each fill (sup_res), fraction of the price")
+    parser.add_argument("--seed", type = int)
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(), help = "Number of processes")
+    parser.add_argument("--output", help = "Results file (.parquet / .json / .jsonl)")
+    args = parser.parse_args()
+
+    results = walk_forward(args.exchange, args.symbol, args.strategy, args.tf, parse_time(args.from_time, 0),
+                           parse_time(args.to_time, int(pd.Timestamp.now(tz = "UTC").value // 1_000_000)), args.folds,
+                           args.population_size, args.generations, args.scheme, max(1, args.jobs), args.seed,
+                           {option: getattr(args, option) for option in ["fee", "slippage"] if getattr(args, option) is not None})
+
+    print(summarize(results))
+
+    if args.output is not None:
+        write_results(results, args.output)